@@ -0,0 +1,209 @@
+from __future__ import print_function
+import numpy as np
+
+from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, fit_group
+
+
+class AdaptiveScan(object):
+    """Choose the points of a scan batch by batch, where the fitted scaling is least certain
+
+    Each process is fit on its own (see `CrossSectionScan.fit`). The variance of the
+    predicted scaling at a point x is a C a^T, where a are the model terms of x (see
+    `CrossSectionScan.model`) and C is the covariance of the fit constants. The next
+    batch is picked greedily from random candidates: the candidate with the largest
+    predicted variance is taken, C is updated as if it had been calculated, and so on.
+    Updating C keeps the points of a batch from clustering where the variance was
+    largest initially.
+
+    A process is done once the predicted scaling changes by less than `tolerance`
+    (relative to the scaling) anywhere in the candidates between two iterations.
+    """
+
+    def __init__(self, coefficients, processes, mins, maxes, scan=None, batch_size=10, candidates=10000,
+                 tolerance=0.01, seed=None, max_failures=3):
+        """
+        Parameters
+        ----------
+            coefficients : tuple of str
+                The coefficients to scan.
+            processes : list of str
+                The processes to scan.
+            mins : dict or list
+                The lower bound of each coefficient, by column (see `get_bounds`).
+            maxes : dict or list
+                The upper bound of each coefficient, by column.
+            scan : CrossSectionScan
+                Points which have already been calculated. Newly calculated points are added to it.
+            batch_size : int
+                The number of points to propose per process and iteration.
+            candidates : int
+                The number of random candidates to choose each batch from.
+            tolerance : float
+                The relative change in the predicted scaling below which a process is done.
+            seed : int
+                Seed for the random candidates.
+            max_failures : int
+                Give up on a process after this many consecutive batches in which every point failed.
+        """
+        # CrossSectionScan stores points with the coefficients sorted
+        columns = sorted(range(len(coefficients)), key=lambda k: coefficients[k])
+        self.coefficients = tuple(coefficients[k] for k in columns)
+        self.processes = list(processes)
+        self.mins = np.array([mins[k] for k in columns])
+        self.maxes = np.array([maxes[k] for k in columns])
+        self.scan = CrossSectionScan() if scan is None else scan
+        self.batch_size = batch_size
+        self.candidates = candidates
+        self.tolerance = tolerance
+        self.random = np.random.RandomState(seed)
+
+        # the fit of each process from the last iteration, and the relative change since the one before
+        self.constants = {}
+        self.covariances = {}
+        self.changes = {}
+        self.converged = set()
+        # the number of consecutive batches without any calculated point, and the processes given up on
+        self.max_failures = max_failures
+        self.failures = dict((process, 0) for process in self.processes)
+        self.failed = set()
+
+        # candidates to check the convergence with are kept fixed, so changes are comparable
+        self.reference = self.sample(candidates)
+
+    @property
+    def terms(self):
+        """The number of fit constants, which is the minimum number of points to fit
+        """
+        dim = len(self.coefficients)
+        return 1 + 2 * dim + dim * (dim - 1) // 2
+
+    def sample(self, count):
+        return self.random.uniform(self.mins, self.maxes, (count, len(self.coefficients)))
+
+    def points(self, process):
+        if process not in self.scan.points[self.coefficients]:
+            return np.zeros((0, len(self.coefficients)))
+        return self.scan.points[self.coefficients][process]
+
+    def fit(self, process):
+        """Fit the scaling of a process, and update whether it has converged
+
+        Returns
+        ----------
+            bool
+                True if the process could be fit, which requires the SM point
+                and at least as many points as fit constants.
+        """
+        points = self.points(process)
+        if len(points) < self.terms or not np.any(np.all(points == 0, axis=1)):
+            return False
+
+        scales, variances = self.scan.scales(self.coefficients, process)
+        constants, covariance = fit_group((points, scales, variances))
+
+        A = CrossSectionScan.model(self.reference)
+        if process in self.constants:
+            predicted = np.dot(A, constants)
+            change = np.abs(np.dot(A, constants - self.constants[process])) / np.maximum(np.abs(predicted), 1e-12)
+            self.changes[process] = change.max()
+            if self.changes[process] < self.tolerance:
+                self.converged.add(process)
+        self.constants[process] = constants
+        self.covariances[process] = covariance
+
+        return True
+
+    def propose(self, process):
+        """Return the next batch of points for a process
+        """
+        points = self.points(process)
+        if process not in self.covariances:
+            # not enough points to fit yet; start with the SM point and random points
+            count = max(self.batch_size, 2 * self.terms - len(points))
+            batch = self.sample(count)
+            if not np.any(np.all(points == 0, axis=1)):
+                batch[0] = 0.
+            return batch
+
+        candidates = self.sample(self.candidates)
+        A = CrossSectionScan.model(candidates)
+        C = self.covariances[process]
+        variances = np.sum(np.dot(A, C) * A, axis=1)
+
+        # the variance of a new point is extrapolated from those of the calculated points,
+        # relative to the predicted scaling
+        scales, errs = self.scan.scales(self.coefficients, process)
+        relative = np.median(errs / np.abs(scales))
+        noise = np.maximum(relative * np.abs(np.dot(A, self.constants[process])), 1e-12)
+
+        chosen = []
+        for _ in range(min(self.batch_size, len(candidates))):
+            best = np.argmax(variances)
+            chosen.append(best)
+            # update the covariance for having calculated the chosen point (Sherman-Morrison)
+            c = np.dot(C, A[best])
+            denominator = noise[best] + np.dot(A[best], c)
+            C = C - np.outer(c, c) / denominator
+            variances = variances - np.dot(A, c) ** 2 / denominator
+            variances[chosen] = -np.inf
+
+        return candidates[chosen]
+
+    def add(self, process, result):
+        """Add the points calculated for a process
+
+        A batch in which every point failed is counted, and the process is given up
+        on after `max_failures` of them in a row.
+        """
+        if process not in result.points[self.coefficients] or len(result.points[self.coefficients][process]) == 0:
+            self.failures[process] += 1
+            print('no points were calculated for {} ({} batches in a row)'.format(process, self.failures[process]))
+            if self.failures[process] >= self.max_failures:
+                print('giving up on {}'.format(process))
+                self.failed.add(process)
+            return
+        self.failures[process] = 0
+        self.scan.add(
+            result.points[self.coefficients][process],
+            result.cross_sections[self.coefficients][process],
+            result.errs[self.coefficients][process],
+            process,
+            self.coefficients
+        )
+
+    def run(self, calculate, iterations=20, callback=None):
+        """Calculate batches of points until every process has converged
+
+        Parameters
+        ----------
+            calculate : function
+                Called with a process and an array of points (with columns in the order of
+                `self.coefficients`, which is sorted), and returns a CrossSectionScan with the
+                points which were calculated (for example, `MadgraphRunner.run`).
+            iterations : int
+                The maximum number of batches to calculate per process.
+            callback : function
+                Called with the scan after each iteration, for example to save it.
+
+        Returns
+        ----------
+            CrossSectionScan
+                All calculated points.
+        """
+        for iteration in range(iterations):
+            for process in self.processes:
+                self.fit(process)
+            todo = [p for p in self.processes if p not in self.converged and p not in self.failed]
+            print('iteration {}: {} of {} processes converged, {} failed'.format(
+                iteration, len(self.converged), len(self.processes), len(self.failed)))
+            for process in sorted(self.changes):
+                print('    {}: predicted scaling changed by up to {:.2%}'.format(process, self.changes[process]))
+            if len(todo) == 0:
+                break
+
+            for process in todo:
+                self.add(process, calculate(process, self.propose(process)))
+            if callback is not None:
+                callback(self.scan)
+
+        return self.scan
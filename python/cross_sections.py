@@ -1,34 +1,74 @@
 from __future__ import print_function
+import collections
+import gzip
 import itertools
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import signal
 import subprocess
+import sys
 import tabulate
+import threading
 import time
 import glob
-import xml.etree.ElementTree as ET
 
 import numpy as np
 import scipy
-import scipy.optimize
+import scipy.linalg
+import scipy.special
 
-from NPFitProduction.NPFitProduction.utils import cartesian_product, TupleKeyDict, TempDir, sorted_combos
+from NPFitProduction.NPFitProduction.lheReader import lheReader
+from NPFitProduction.NPFitProduction.utils import CardTemplate, ColumnStore, Grid, NpzArchive, ParamCard, TupleKeyDict, \
+    TempDir, sorted_combos
 
 logger = logging.getLogger(__name__)
 
+SCAN_FORMAT_VERSION = 2
+
+# patterns for parsing the output of Madgraph's generate_events, see `run_generate_events`
+MADGRAPH_CROSS_SECTION = re.compile("Cross-section :\s*(.*) \+\- (.*) pb")
+MADGRAPH_PHASES = [
+    ('survey', re.compile('Running Survey')),
+    ('refine', re.compile('Refine results')),
+    ('combine', re.compile('Combining Events')),
+    ('store', re.compile('Storing parton level results')),
+    ('reweight', re.compile('Running Reweighting', re.IGNORECASE)),
+]
+MADGRAPH_FAILURES = [
+    re.compile('Command ".*" interrupted with error'),
+    re.compile('Error detected in'),
+    re.compile('Zero result detected', re.IGNORECASE),
+    re.compile('cross-section is zero', re.IGNORECASE),
+]
+# an uncommented mg5_path setting in me5_configuration.txt, see `get_cross_sections_reweighted`
+MADGRAPH_PATH_SETTING = re.compile('^\s*mg5_path\s*=', re.MULTILINE)
+
 # TODO keep track of dimensions
 class CrossSectionScan(object):
     """A container for cross section scans over Wilson coefficient values.
 
     """
 
-    def __init__(self, fn=None):
-        self.points = TupleKeyDict()
-        self.cross_sections = TupleKeyDict()
+    def __init__(self, fn=None, mmap_mode=None):
+        # points, cross sections and errs are appended to one ColumnStore per
+        # (coefficients, process); the `points`, `cross_sections`, and `errs`
+        # attributes are views of them which are refreshed when read
+        self.stores = TupleKeyDict()
+        self._points = TupleKeyDict()
+        self._cross_sections = TupleKeyDict()
         # TODO better name
-        self.errs = TupleKeyDict()
+        self._errs = TupleKeyDict()
+        # (coefficients, process) of stores changed since the views were refreshed, in the
+        # order they were changed, so the views are always built in the same order
+        self._stale = collections.OrderedDict()
+        # rows of SM points per process and coefficients, and the SM cross section and error per process
+        self._sm_rows = {}
+        self._sm_references = {}
+        # fit constants per (process, coefficients), as returned by `construct`
+        self._constants = {}
         self.fit_constants = TupleKeyDict()
         self.fit_constants_errs = TupleKeyDict()
         self.covariances = TupleKeyDict()
@@ -37,10 +77,55 @@ class CrossSectionScan(object):
             if isinstance(fn, list):
                 self.loadmany(fn)
             elif os.path.isfile(fn):
-                self.load(fn)
+                self.load(fn, mmap_mode)
             else:
                 raise IOError('cannot find {}'.format(fn))
 
+    @property
+    def points(self):
+        self.materialize()
+        return self._points
+
+    @property
+    def cross_sections(self):
+        self.materialize()
+        return self._cross_sections
+
+    @property
+    def errs(self):
+        self.materialize()
+        return self._errs
+
+    def materialize(self):
+        """Refresh the views of any stores which have changed since they were last read
+        """
+        for coefficients, process in self._stale:
+            store = self.stores[coefficients][process]
+            self._points[coefficients][process] = store.points
+            self._cross_sections[coefficients][process] = store.cross_sections
+            self._errs[coefficients][process] = store.errs
+        self._stale.clear()
+
+    def set(self, points, cross_sections, errs, process, coefficients):
+        """Replace the points of (coefficients, process)
+
+        Unlike `add`, the arrays are not copied and the coefficients are assumed to be sorted.
+        """
+        coefficients = tuple([coefficients]) if isinstance(coefficients, str) else tuple(coefficients)
+        self.stores[coefficients][process] = ColumnStore.from_arrays(points, cross_sections, errs)
+        self._stale[(coefficients, process)] = None
+        self._sm_rows.setdefault(process, {})[coefficients] = []
+        self._sm_references.pop(process, None)
+        self.index_sm_points(points, process, coefficients, 0)
+
+    def index_sm_points(self, points, process, coefficients, offset):
+        """Record which of `points`, stored starting at row `offset`, are the SM point
+        """
+        rows = np.where(np.all(points == 0, axis=1))[0] + offset
+        if len(rows) > 0:
+            self._sm_rows.setdefault(process, {}).setdefault(coefficients, []).extend(rows.tolist())
+            self._sm_references.pop(process, None)
+
     def __repr__(self):
         msg = ['{:40s} {:5s} {:5s} {:>50s} {:>55s} {:10s}'.format(
             'coefficients', 'process', 'points', 'min values', 'max values', 'max scaling')]
@@ -62,59 +147,55 @@ class CrossSectionScan(object):
                 ]
         return '\n'.join(msg)
 
-    def load(self, fn):
-        try:
-            info = np.load(fn)
-        except (UnicodeError, UnicodeDecodeError):
-            info = np.load(fn, encoding='utf8')
-        info = np.load(fn)
-        self.points = TupleKeyDict(info['points'][()])
-        self.cross_sections = TupleKeyDict(info['cross_sections'][()])
-        self.fit_constants = TupleKeyDict(info['fit_constants'][()])
-        try:
-            self.errs = TupleKeyDict(info['errs'][()])
-        except:
-            for coefficients in self.points:
-                self.errs[coefficients] = {}
-                for process in self.points[coefficients]:
-                    self.errs[coefficients][process] = np.zeros(self.cross_sections[coefficients][process].shape)
+    def load(self, fn, mmap_mode=None):
+        """Load a scan file, replacing the current contents
+
+        Parameters
+        ----------
+            fn : str
+                File written by `dump`; legacy files holding pickled dictionaries are also accepted.
+            mmap_mode : {None, 'r', 'c'}
+                If set, memory-map the arrays instead of reading them (only for files written by `dump`).
+                Use 'c' (copy-on-write) if the points will be modified in place, e.g. by `convert`.
+        """
+        entries, fit_constants, fit_constants_errs = read_scan(fn, mmap_mode)
+
+        self.stores = TupleKeyDict()
+        self._points = TupleKeyDict()
+        self._cross_sections = TupleKeyDict()
+        self._errs = TupleKeyDict()
+        self._stale.clear()
+        self._sm_rows = {}
+        self._sm_references = {}
+        for entry in entries:
+            self.set(*entry)
+        self.fit_constants = fit_constants
+        self.fit_constants_errs = fit_constants_errs
+        self._constants = {}
 
     def loadmany(self, files):
         """Load a list of files
+
+        Returns
+        ----------
+            bad : list of str
+                The files which could not be read and were skipped.
         """
         files = sum([glob.glob(f) for f in files], [])
 
+        bad = []
         for f in files:
-            state = (self.points, self.cross_sections, self.errs)
             try:
-                try:
-                    info = np.load(f)
-                except (UnicodeError, UnicodeDecodeError):
-                    info = np.load(f, encoding='utf8')
-                points = info['points'][()]
-                cross_sections = info['cross_sections'][()]
-                try:
-                    errs = info['errs'][()]
-                except:
-                    errs = TupleKeyDict()
-                    for coefficients in points:
-                        errs[coefficients] = {}
-                        for process in points[coefficients]:
-                            errs[coefficients][process] = np.zeros(cross_sections[coefficients][process].shape)
-                for coefficients in points:
-                    for process in points[coefficients]:
-                        self.add(
-                            points[coefficients][process],
-                            cross_sections[coefficients][process],
-                            errs[coefficients][process],
-                            process,
-                            coefficients
-                        )
+                # read everything before adding anything, so a bad file leaves the scan untouched
+                entries, _, _ = read_scan(f)
             except Exception as e:
-                self.points = state[0]
-                self.cross_sections = state[1]
-                self.errs = state[2]
                 print('skipping bad input file {}: {}'.format(f, e))
+                bad.append(f)
+                continue
+            for entry in entries:
+                self.add(*entry)
+
+        return bad
 
     def add(self, points, cross_section, err, process, coefficients):
         if isinstance(points, list):
@@ -128,21 +209,12 @@ class CrossSectionScan(object):
             cross_section = np.array([cross_section])
         if not isinstance(err, np.ndarray):
             err = np.array([err])
-        if coefficients in self.points:
-            if process in self.points[coefficients]:
-                self.points[coefficients][process] = np.vstack([self.points[coefficients][process], points])
-                self.cross_sections[coefficients][process] = np.hstack(
-                    [self.cross_sections[coefficients][process], cross_section])
-                self.errs[coefficients][process] = np.hstack(
-                    [self.errs[coefficients][process], err])
-            else:
-                self.points[coefficients][process] = points
-                self.cross_sections[coefficients][process] = cross_section
-                self.errs[coefficients][process] = err
-        else:
-            self.points[coefficients] = {process: points}
-            self.cross_sections[coefficients] = {process: cross_section}
-            self.errs[coefficients] = {process: err}
+        if process not in self.stores[coefficients]:
+            self.stores[coefficients][process] = ColumnStore(len(coefficients))
+        store = self.stores[coefficients][process]
+        self.index_sm_points(points, process, coefficients, len(store))
+        store.append(points, cross_section, err)
+        self._stale[(coefficients, process)] = None
 
     def deduplicate(self, coefficients, process):
         """Deduplicate points
@@ -160,26 +232,39 @@ class CrossSectionScan(object):
 
         See https://stackoverflow.com/questions/31878240
         """
-        sort = np.lexsort(self.points[coefficients][process].T)
-        mask = np.append(True, np.any(np.diff(self.points[coefficients][process][sort], axis=0), axis=1))
+        store = self.stores[coefficients][process]
+        sort = np.lexsort(store.points.T)
+        mask = np.append(True, np.any(np.diff(store.points[sort], axis=0), axis=1))
         tag = mask.cumsum() - 1
-        averages = np.bincount(tag, self.cross_sections[coefficients][process][sort]) / np.bincount(tag)
-        self.cross_sections[coefficients][process] = averages
-        self.points[coefficients][process] = self.points[coefficients][process][sort][mask]
+        counts = np.bincount(tag)
+        averages = np.bincount(tag, store.cross_sections[sort]) / counts
+        errs = np.sqrt(np.bincount(tag, store.errs[sort] ** 2)) / counts
+        self.set(store.points[sort][mask], averages, errs, process, coefficients)
+
+    def sm_reference(self, process):
+        """Return the SM cross section and its error for `process`
+
+        This is the average over the SM points of every coefficient group. The SM points
+        are indexed as they are added, and the average is cached until they change.
+        """
+        if process not in self._sm_references:
+            sm_cross_sections = []
+            sm_errs = []
+            for coefficients, rows in self._sm_rows.get(process, {}).items():
+                store = self.stores[coefficients][process]
+                sm_cross_sections += store.cross_sections[rows].tolist()
+                sm_errs += store.errs[rows].tolist()
+            if len(sm_cross_sections) == 0:
+                raise RuntimeError('scan does not contain the SM point for process {}'.format(process))
+
+            sm_cross_section = np.mean(np.array(sm_cross_sections))
+            sm_err = np.sqrt(sum(np.array(sm_errs) ** 2)) / len(sm_errs)
+            self._sm_references[process] = (sm_cross_section, sm_err)
+
+        return self._sm_references[process]
 
     def scales(self, coefficients, process):
-        sm_cross_sections = []
-        sm_errs = []
-        for c in self.points:
-            if process in self.points[c]:
-                sm_indices = np.where(np.all(self.points[c][process] == 0, axis=1))[0]
-                sm_cross_sections += self.cross_sections[c][process][sm_indices].tolist()
-                sm_errs += self.errs[c][process][sm_indices].tolist()
-        if len(sm_cross_sections) == 0:
-            raise RuntimeError('scan does not contain the SM point for process {}'.format(process))
-
-        sm_cross_section = np.mean(np.array(sm_cross_sections))
-        sm_err = np.sqrt(sum(np.array(sm_errs) ** 2)) / len(sm_errs)
+        sm_cross_section, sm_err = self.sm_reference(process)
 
         self.cross_sections['sm'][process] = sm_cross_section
         self.errs['sm'][process] = sm_err
@@ -193,19 +278,56 @@ class CrossSectionScan(object):
         return scale, scale_err
 
     def prune(self, process, coefficients):
-        self.points[coefficients] = dict((k, v) for k, v in self.points[coefficients].items() if k != process)
-        self.cross_sections[coefficients] = dict((k, v) for k, v in self.cross_sections[coefficients].items() if k != process)
+        coefficients = tuple([coefficients]) if isinstance(coefficients, str) else tuple(coefficients)
+        self.materialize()
+        for columns in [self.stores, self._points, self._cross_sections, self._errs]:
+            columns[coefficients].pop(process, None)
+        self._sm_rows.get(process, {}).pop(coefficients, None)
+        self._sm_references.pop(process, None)
 
     def dump(self, filename):
-        np.savez(
-            filename,
-            points=dict(self.points),
-            cross_sections=dict(self.cross_sections),
-            fit_constants=dict(self.fit_constants),
-            errs=dict(self.errs)
-        )
-
-    def model(self, points):
+        """Write the scan to `filename`
+
+        Each (coefficients, process) is written as flat arrays, with an index of
+        coefficients and processes, to an uncompressed .npz file which can be read
+        without unpickling and memory-mapped by `load`.
+        """
+        arrays = {'format_version': np.array(SCAN_FORMAT_VERSION)}
+        coefficients_index = []
+        processes_index = []
+        for coefficients in self.stores:
+            for process, store in self.stores[coefficients].items():
+                i = len(processes_index)
+                coefficients_index.append(','.join(coefficients))
+                processes_index.append(process)
+                arrays['points_{}'.format(i)] = store.points
+                arrays['cross_sections_{}'.format(i)] = store.cross_sections
+                arrays['errs_{}'.format(i)] = store.errs
+        arrays['coefficients'] = np.array(coefficients_index, dtype=str)
+        arrays['processes'] = np.array(processes_index, dtype=str)
+
+        fit_processes = []
+        fit_terms = []
+        fit_constants = []
+        fit_constants_errs = []
+        for process in self.fit_constants:
+            for term, value in self.fit_constants[process].items():
+                fit_processes.append(process[0])
+                fit_terms.append(','.join(term))
+                fit_constants.append(value[0])
+                try:
+                    fit_constants_errs.append(self.fit_constants_errs[process][term][0])
+                except KeyError:
+                    fit_constants_errs.append(np.nan)
+        arrays['fit_processes'] = np.array(fit_processes, dtype=str)
+        arrays['fit_terms'] = np.array(fit_terms, dtype=str)
+        arrays['fit_constants'] = np.array(fit_constants, dtype=float)
+        arrays['fit_constants_errs'] = np.array(fit_constants_errs, dtype=float)
+
+        np.savez(filename, **arrays)
+
+    @staticmethod
+    def model(points):
         rows, dim = points.shape
         pairs = sorted(list(itertools.combinations(range(0, dim), 2)))
 
@@ -217,30 +339,36 @@ class CrossSectionScan(object):
         return np.hstack([constant, linear, quad, mixed])
 
     def construct(self, process, coefficients):
-        # from IPython.core import debugger
-        # debugger.Pdb().set_trace()
+        """Return the fit constants of `process` ordered as the columns of `model`
+
+        The result is cached per (process, coefficients) until the scan is refit.
+        """
         if isinstance(coefficients, str):
             coefficients = tuple([coefficients])
+        coefficients = tuple(coefficients)
+        if (process, coefficients) in self._constants:
+            return self._constants[(process, coefficients)]
+
         pairs = sorted(list(itertools.combinations(range(0, len(coefficients)), 2)))
 
         if () not in self.fit_constants[process].keys():
             self.fit()
-        res = self.fit_constants[process][()]
+        res = [self.fit_constants[process][()]]
 
         for linear in coefficients:
-            constant = self.fit_constants[process][(linear,)]
-            res = np.concatenate([res, constant])
+            res.append(self.fit_constants[process][(linear,)])
         for quad in coefficients:
-            constant = self.fit_constants[process][(quad, quad)]
-            res = np.concatenate([res, constant])
+            res.append(self.fit_constants[process][(quad, quad)])
         for mixed in pairs:
             try:
                 constant = self.fit_constants[process][(coefficients[mixed[0]], coefficients[mixed[1]])]
             except KeyError:
                 constant = self.fit_constants[process][(coefficients[mixed[1]], coefficients[mixed[0]])]
-            res = np.concatenate([res, constant])
+            res.append(constant)
 
-        return res
+        self._constants[(process, coefficients)] = np.concatenate(res)
+
+        return self._constants[(process, coefficients)]
 
     def dump_constants(self, process, coefficients, labels=None, sigfigs=10, tweak=1.):
         # from IPython.core import debugger
@@ -287,7 +415,7 @@ class CrossSectionScan(object):
                     self.points[coefficients][process][:, column] *= conversion[c]
 
 
-    def fit(self, maxpoints=None, dimensions=None):
+    def fit(self, maxpoints=None, dimensions=None, workers=1):
         """Perform a fit to describe how processes are scaled as a function of Wilson coefficients
 
         The matrix element M can be expressed in terms of the SM piece M_0 and NP
@@ -307,10 +435,16 @@ class CrossSectionScan(object):
         operators. In practice, overconstraining the fit with more than the minimum number of points
         is helpful, because the MG calculation has associated errors.
 
+        Each (coefficients, process) is fit independently; with `workers` > 1 the fits are
+        distributed over a process pool. Results are combined in the same order regardless
+        of `workers`, so the fit constants do not depend on it.
+
         """
         self.fit_constants = TupleKeyDict()
+        self._constants = {}
         self.fit_constants_raw = TupleKeyDict()
         self.fit_constants_weights = TupleKeyDict()
+        tasks = []
         for coefficients in self.points:
             for process, points in self.points[coefficients].items():
                 # TODO switch back to only one dimension fit
@@ -327,31 +461,30 @@ class CrossSectionScan(object):
                         scales = scales[indices[:maxpoints]]
                         variances = variances[indices[:maxpoints]]
                     print('fitting {} {} using {} points'.format(str(coefficients), process, str(len(points))))
-                    A = self.model(points)
-                    rows, cols = A.shape
-                    # the fit must go through the SM point, so weight it
-                    np.clip(variances, 1e-15, 1e15, variances)
-                    # weights = np.diag([1 if row else 1 for row in np.all(points == 0, axis=1)])
-                    # weights = np.diag([1e10 if row else 1 for row in np.all(points == 0, axis=1)])
-                    # weights = np.diag(1 / (variances))
-                    weights = np.diag(1 / (variances)) + np.diag([1e10 if row else 1 for row in np.all(points == 0, axis=1)])
-                    # weights = np.diag(1 / (variances ** 2)) + np.diag([1e10 if row else 1 for row in np.all(points == 0, axis=1)])
-                    # let the NP scaling per point be represented by B
-                    # and the fit constants we want by X;
-                    # this solves AX = B by computing the X which minimizes ||B - AX||^2
-                    constants, _, _, _ = np.linalg.lstsq(np.dot(weights, A), np.dot(scales, weights))
-                    # V_scales= np.diag(variances ** 2)
-                    V_scales= np.diag(variances)
-                    self.covariances[coefficients][process] = np.linalg.inv(np.dot(A.T, np.dot(np.linalg.inv(V_scales), A)))
-                    constant_variances = np.diag(np.sqrt(np.abs(self.covariances[coefficients][process])))
-                    pairs = sorted(list(itertools.combinations(range(0, len(coefficients)), 2)))
-                    linear = [(l,) for l in coefficients]
-                    quad = [(q, q) for q in coefficients]
-                    mixed = [(coefficients[mixed[0]], coefficients[mixed[1]]) for mixed in pairs]
-                    for i, term in enumerate([()] + linear + quad + mixed):
-                        self.update(process, term, constants[i], constant_variances[i], len(points))
+                    tasks.append((coefficients, process, points, scales, variances))
+
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(fit_group, [task[2:] for task in tasks])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [fit_group(task[2:]) for task in tasks]
+
+        for (coefficients, process, points, _, _), (constants, covariance) in zip(tasks, results):
+            self.covariances[coefficients][process] = covariance
+            constant_variances = np.diag(np.sqrt(np.abs(covariance)))
+            pairs = sorted(list(itertools.combinations(range(0, len(coefficients)), 2)))
+            linear = [(l,) for l in coefficients]
+            quad = [(q, q) for q in coefficients]
+            mixed = [(coefficients[mixed[0]], coefficients[mixed[1]]) for mixed in pairs]
+            for i, term in enumerate([()] + linear + quad + mixed):
+                self.update(process, term, constants[i], constant_variances[i], len(points))
 
     def update(self, process, term, value, err, weight):
+        self._constants = {}
         if term in self.fit_constants[process]:
             self.fit_constants_weights[process][term] += [weight]
             self.fit_constants_raw[process][term] += [value]
@@ -388,10 +521,40 @@ class CrossSectionScan(object):
         if len(points.shape) == 1:
             points = points.reshape((len(points), 1))
 
-        A = self.model(points)
-        constants = self.construct(process, coefficients)
+        return self.evaluate_many(coefficients, points, [process])[:, 0]
+
+    def evaluate_many(self, coefficients, points, processes, chunksize=100000):
+        """Evaluate the fitted scaling of several processes at many points
+
+        Parameters
+        ----------
+            coefficients : tuple of str
+                The coefficients corresponding to the columns of `points`.
+            points : np.ndarray
+                The points to evaluate, with one row per point. A single point
+                or a list is reshaped to rows of len(coefficients) values.
+            processes : list of str
+                The processes to evaluate.
+            chunksize : int
+                Number of points to evaluate at once; this bounds the size of the
+                intermediate model matrix.
+
+        Returns
+        ----------
+            np.ndarray
+                The scaling, with one row per point and one column per process.
+        """
+        if isinstance(coefficients, str):
+            coefficients = tuple([coefficients])
+        points = np.asarray(points, dtype=float).reshape(-1, len(coefficients))
+        constants = np.column_stack([self.construct(process, coefficients) for process in processes])
 
-        return np.dot(A, constants)
+        res = np.empty((len(points), len(processes)))
+        for start in range(0, len(points), chunksize):
+            stop = start + chunksize
+            res[start:stop] = np.dot(self.model(points[start:stop]), constants)
+
+        return res
 
     def round(self, f, sig_figs):
         if isinstance(f, np.ndarray):
@@ -455,39 +618,331 @@ class CrossSectionScan(object):
         return df
 
 
+def fit_group(args):
+    """Fit the scaling of one (coefficients, process), see `CrossSectionScan.fit`
+
+    Parameters
+    ----------
+        args : tuple
+            (points, scales, variances); a single argument so it can be mapped over by a process pool.
+
+    Returns
+    ----------
+        constants : np.ndarray
+            The fit constants, ordered as the columns of `CrossSectionScan.model`.
+        covariance : np.ndarray
+            The covariance matrix of the fit constants.
+    """
+    points, scales, variances = args
+    A = CrossSectionScan.model(points)
+    # the fit must go through the SM point, so weight it
+    variances = np.clip(variances, 1e-15, 1e15)
+    # the weights form a diagonal matrix W, so only its diagonal is kept
+    # and WA and WB are computed by scaling rows
+    # weights = 1 / variances
+    weights = 1 / variances + np.where(np.all(points == 0, axis=1), 1e10, 1)
+    # let the NP scaling per point be represented by B
+    # and the fit constants we want by X;
+    # this solves WAX = WB by computing the X which minimizes ||WB - WAX||^2
+    constants, _, _, _ = np.linalg.lstsq(A * weights[:, np.newaxis], scales * weights, rcond=-1)
+
+    return constants, parameter_covariance(A, variances)
+
+def parameter_covariance(A, variances):
+    """Return the covariance of least squares parameters
+
+    This is (A^T V^-1 A)^-1, where V is the diagonal matrix of `variances`. It is
+    computed from the QR decomposition A / sqrt(V) = QR, since then A^T V^-1 A = R^T R,
+    so the cost is linear in the number of rows of A.
+
+    Parameters
+    ----------
+        A : np.ndarray
+            The design matrix, with one row per point.
+        variances : np.ndarray
+            The variance of each point.
+    """
+    R = np.linalg.qr(A / np.sqrt(variances)[:, np.newaxis], mode='r')
+    R_inv = scipy.linalg.solve_triangular(R, np.eye(len(R)))
+
+    return np.dot(R_inv, R_inv.T)
+
+def read_scan(fn, mmap_mode=None):
+    """Read the contents of a scan file written by `CrossSectionScan.dump`
+
+    Parameters
+    ----------
+        fn : str
+            The file to read. Legacy files holding pickled dictionaries are also accepted.
+        mmap_mode : {None, 'r', 'c'}
+            If set, memory-map the arrays instead of reading them. Ignored for legacy files.
+
+    Returns
+    ----------
+        entries : list of tuple
+            (points, cross_sections, errs, process, coefficients) for each
+            coefficient group and process in the file.
+        fit_constants : TupleKeyDict
+        fit_constants_errs : TupleKeyDict
+    """
+    archive = NpzArchive(fn, mmap_mode)
+    if 'format_version' not in archive:
+        return read_legacy_scan(fn)
+
+    def decode(labels):
+        return [str(x) if isinstance(x, str) else x.decode('utf8') for x in labels]
+
+    def split(label):
+        return tuple(label.split(',')) if label else ()
+
+    entries = []
+    for i, (coefficients, process) in enumerate(zip(decode(archive['coefficients']), decode(archive['processes']))):
+        entries.append((
+            archive['points_{}'.format(i)],
+            archive['cross_sections_{}'.format(i)],
+            archive['errs_{}'.format(i)],
+            process,
+            split(coefficients)
+        ))
+
+    fit_constants = TupleKeyDict()
+    fit_constants_errs = TupleKeyDict()
+    values = zip(
+        decode(archive['fit_processes']),
+        decode(archive['fit_terms']),
+        archive['fit_constants'],
+        archive['fit_constants_errs']
+    )
+    for process, term, value, err in values:
+        fit_constants[process][split(term)] = np.array([value])
+        if not np.isnan(err):
+            fit_constants_errs[process][split(term)] = np.array([err])
+
+    return entries, fit_constants, fit_constants_errs
+
+def read_legacy_scan(fn):
+    """Read a scan file written as pickled dictionaries by older versions of `CrossSectionScan.dump`
+    """
+    try:
+        try:
+            info = np.load(fn, allow_pickle=True)
+        except TypeError:
+            info = np.load(fn)
+    except (UnicodeError, UnicodeDecodeError):
+        info = np.load(fn, encoding='utf8')
+    points = info['points'][()]
+    cross_sections = info['cross_sections'][()]
+    try:
+        errs = info['errs'][()]
+    except:
+        errs = TupleKeyDict()
+        for coefficients in points:
+            errs[coefficients] = {}
+            for process in points[coefficients]:
+                errs[coefficients][process] = np.zeros(cross_sections[coefficients][process].shape)
+    entries = []
+    for coefficients in points:
+        for process in points[coefficients]:
+            entries.append((
+                points[coefficients][process],
+                cross_sections[coefficients][process],
+                errs[coefficients][process],
+                process,
+                tuple(coefficients)
+            ))
+    try:
+        fit_constants = TupleKeyDict(info['fit_constants'][()])
+    except KeyError:
+        fit_constants = TupleKeyDict()
+
+    return entries, fit_constants, TupleKeyDict()
+
+def merge_batch(args):
+    """Merge a batch of scan files into one
+
+    Parameters
+    ----------
+        args : tuple
+            (infiles, outfile); a single argument so it can be mapped over by a process pool.
+
+    Returns
+    ----------
+        bad : list of str
+            The input files which could not be read.
+    """
+    infiles, outfile = args
+    scan = CrossSectionScan()
+    bad = scan.loadmany(infiles)
+    scan.dump(outfile)
+
+    return bad
+
+def merge_scans(outfile, files, workers=1, batch_size=50):
+    """Merge scan files into `outfile`
+
+    Batches of `batch_size` input files are merged into partial scans in a process pool, and
+    the partial scans are then merged pairwise until one remains. Partial scans are written
+    to disk between steps, so no process holds more than one batch or pair in memory.
+
+    Parameters
+    ----------
+        outfile : str
+            The merged output file.
+        files : list of str
+            The files to merge.
+        workers : int
+            Number of processes to use.
+        batch_size : int
+            Number of input files per initial merge.
+
+    Returns
+    ----------
+        bad : list of str
+            The input files which could not be read and were skipped.
+    """
+    if not outfile.endswith('.npz'):
+        # match the name np.savez would have written
+        outfile += '.npz'
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        mapper = pool.map
+    else:
+        pool = None
+        mapper = map
+
+    bad = []
+    try:
+        with TempDir() as sandbox:
+            def partial(level, i):
+                return os.path.join(sandbox, 'partial_{}_{}.npz'.format(level, i))
+
+            tasks = [(files[i:i + batch_size], partial(0, i)) for i in range(0, len(files), batch_size)]
+            if len(tasks) == 0:
+                tasks = [([], partial(0, 0))]
+            carried = []
+            level = 0
+            while len(tasks) > 0:
+                for skipped in mapper(merge_batch, tasks):
+                    bad += skipped
+                if level > 0:
+                    for infiles, _ in tasks:
+                        for f in infiles:
+                            os.remove(f)
+                outputs = [outfile for _, outfile in tasks] + carried
+                level += 1
+                # an odd partial scan is carried over to the next level
+                tasks = [(outputs[i:i + 2], partial(level, i)) for i in range(0, len(outputs) - 1, 2)]
+                carried = outputs[-1:] if len(outputs) % 2 == 1 else []
+                if len(tasks) > 0:
+                    print('merging {} partial scans'.format(len(outputs)))
+            shutil.move(outputs[0], outfile)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if len(bad) > 0:
+        print('skipped {} bad input files:\n{}'.format(len(bad), '\n'.join(bad)))
+
+    return bad
+
 def get_edge_points(column, mins, maxes, edge, coefficients, num):
-    values = []
-    for j in range(len(coefficients)):
-        if column != j:
-            values += [np.linspace(mins[j], maxes[j], num)]
-        else:
-            values += [np.array([edge])]
+    """Return the grid of `num` values per coefficient with coefficient `column` fixed to `edge`
+
+    The grid is a `Grid`, so points are only calculated when they are indexed.
+    """
+    grid = Grid([np.linspace(mins[j], maxes[j], num) for j in range(len(coefficients))])
 
-    return cartesian_product(*values)
+    return grid.subgrid(column, [edge])
 
 def get_perimeter(mins, maxes, coefficients, numvalues):
-    res = None
-    for i in range(len(coefficients)):
-        if res is not None:
-            res = np.vstack([
-                res,
-                get_edge_points(i, mins, maxes, maxes[i], coefficients, numvalues),
-                get_edge_points(i, mins, maxes, mins[i], coefficients, numvalues)
-            ])
-        else:
-            res = np.vstack([
-                get_edge_points(i, mins, maxes, maxes[i], coefficients, numvalues),
-                get_edge_points(i, mins, maxes, mins[i], coefficients, numvalues)
-            ])
+    """Return the faces of the grid of `numvalues` values per coefficient, as a `GridChain`
+    """
+    return Grid([np.linspace(mins[j], maxes[j], numvalues) for j in range(len(coefficients))]).perimeter()
+
+def quadratic_roots(a, b, c):
+    """Return the real roots of a x^2 + b x + c = 0 for arrays of coefficients
+
+    The roots are computed as q / a and c / q with q = -(b + sign(b) sqrt(b^2 - 4ac)) / 2,
+    which avoids cancellation and reduces to the root of the linear equation as a
+    goes to zero. Missing roots (no real roots, or only one when a = 0) are NaN.
+
+    Returns
+    ----------
+        np.ndarray
+            Array with two rows, one per root.
+    """
+    a, b, c = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (a, b, c)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discriminant = b * b - 4 * a * c
+        q = -0.5 * (b + np.where(b < 0, -1., 1.) * np.sqrt(np.where(discriminant < 0, np.nan, discriminant)))
+        roots = np.vstack([q / a, c / q])
+    roots[~np.isfinite(roots)] = np.nan
+
+    return roots
+
+def quadratic_form(constants, dim):
+    """Split fit constants into the terms of s_0 + b . c + c^T Q c
+
+    Parameters
+    ----------
+        constants : np.ndarray
+            Fit constants ordered as the columns of `CrossSectionScan.model`.
+        dim : int
+            The number of coefficients.
+
+    Returns
+    ----------
+        s0 : float
+        b : np.ndarray
+            The linear terms.
+        Q : np.ndarray
+            The symmetric matrix of quadratic and mixed terms.
+    """
+    s0 = constants[0]
+    b = constants[1:dim + 1]
+    Q = np.diag(constants[dim + 1:2 * dim + 1])
+    for (i, j), mixed in zip(itertools.combinations(range(dim), 2), constants[2 * dim + 1:]):
+        Q[i, j] = Q[j, i] = mixed / 2.
+
+    return s0, b, Q
+
+def constraint_processes(coefficients, coarse_scan, processes=None):
+    """Return the processes which the coarse scan can constrain `coefficients` with
+
+    For each coefficient, the processes of the highest-dimensional scan containing it are
+    considered; the result is the processes common to all coefficients, restricted to
+    `processes` if given.
+    """
+    common = None
+    for coefficient in coefficients:
+        coefficient_sets = [x for x in coarse_scan.points.keys() if coefficient in x]
+        if len(coefficient_sets) == 0:
+            raise RuntimeError('coarse scan is missing {}'.format(coefficient))
+        coefficient_set = sorted(coefficient_sets, key=lambda x: len(x))[-1]
+        coefficient_processes = set(p for p in coarse_scan.points[coefficient_set] if processes is None or p in processes)
+        common = coefficient_processes if common is None else common & coefficient_processes
 
-    return res
+    return sorted(common)
 
-def get_bounds(coefficients, coarse_scan, scale):
-    """Return a grid of points with dimensionality
-    equal to the number of coefficients, and each axis spanning the
-    minimum and maximum c_j for which NP / SM < scale, for any of the
+def get_bounds(coefficients, coarse_scan, scale, surface=False, processes=None, limit=(4 * np.pi) ** 2):
+    """Return the minimum and maximum c_j for which NP / SM < scale, for all of the
     processes in the coarse scan.
 
+    By default, each coefficient is considered separately (with the others fixed to
+    zero), using the fit s_0 + s_1 c_j + s_2 c_j^2 for each of the processes of
+    `constraint_processes`. The bounds are the roots of the quadratic closest to zero
+    on either side, and are solved for all coefficients and processes at once.
+
+    With `surface`, the full fitted surface including the mixed terms is used
+    instead. If the quadratic form is positive definite, the region NP / SM < scale
+    is an ellipsoid, and the bounds are the intersection of the bounding boxes of
+    the ellipsoids of the individual processes. This box contains the intersection
+    of the ellipsoids, but can be larger than its bounding box.
+
+    A process which does not bound a coefficient on one side (or does not bound the
+    region at all, for `surface`) sets that bound to `limit`.
+
     Parameters
     ----------
         coefficients : tuple of str
@@ -496,52 +951,159 @@ def get_bounds(coefficients, coarse_scan, scale):
             The coarse scan to use for setting the coefficient value ranges.
         scale : float
             The maximum ratio of the (cross section)_NP / (cross section)_SM.
+        surface : bool
+            Use the multi-dimensional fitted surface.
+        processes : list of str
+            Only consider these processes (default: all of them).
+        limit : float
+            The largest magnitude to allow for any coefficient value. The default
+            corresponds to the requirement c < (4 * pi)^2 for the convergence of the
+            loop expansion, see section 7 https://arxiv.org/pdf/1205.4231.pdf
 
+    Returns
+    ----------
+        mins : dict
+            The lower bound for each column of `coefficients`.
+        maxes : dict
+            The upper bound for each column of `coefficients`.
     """
+    dim = len(coefficients)
+    columns = []
+    constants = []
+    for column, coefficient in enumerate(coefficients):
+        for process in constraint_processes([coefficient], coarse_scan, processes):
+            columns.append(column)
+            constants.append(coarse_scan.construct(process, coefficient))
+    if len(constants) == 0:
+        raise RuntimeError('coarse scan does not contain any of the processes {}'.format(processes))
+
+    if not surface:
+        s0, s1, s2 = np.array(constants).T
+        if np.any(s0 >= scale):
+            raise RuntimeError('SM point is not below scale {}'.format(scale))
+        roots = quadratic_roots(s2, s1, s0 - scale)
+        with np.errstate(invalid='ignore'):
+            highs = np.where(roots > 0, roots, np.inf).min(axis=0)
+            lows = np.where(roots < 0, roots, -np.inf).max(axis=0)
+    else:
+        columns = []
+        highs = []
+        lows = []
+        for process in constraint_processes(coefficients, coarse_scan, processes):
+            s0, b, Q = quadratic_form(coarse_scan.construct(process, coefficients), dim)
+            if s0 >= scale:
+                raise RuntimeError('SM point is not below scale {} for {}'.format(scale, process))
+            try:
+                np.linalg.cholesky(Q)
+            except np.linalg.LinAlgError:
+                # the region is not bounded
+                continue
+            Q_inv = np.linalg.inv(Q)
+            center = -0.5 * np.dot(Q_inv, b)
+            radius = np.sqrt((scale - s0 + np.dot(center, np.dot(Q, center))) * np.diag(Q_inv))
+            columns += list(range(dim))
+            highs += (center + radius).tolist()
+            lows += (center - radius).tolist()
+
+    maxes = np.full(dim, float(limit))
+    mins = np.full(dim, -float(limit))
+    np.minimum.at(maxes, np.array(columns, dtype=int), np.array(highs, dtype=float))
+    np.maximum.at(mins, np.array(columns, dtype=int), np.array(lows, dtype=float))
+
+    return dict(enumerate(mins)), dict(enumerate(maxes))
+
+def sample_points(coefficients, coarse_scan, scale, count, processes=None, batch_size=100000,
+        max_batches=1000, limit=(4 * np.pi) ** 2, seed=None):
+    """Draw points uniformly from the region where NP / SM < scale for all processes
+
+    Candidates are drawn uniformly, in batches, from whichever is smaller: the bounding box
+    of the region (see `get_bounds`), or the smallest of the ellipsoids NP / SM < scale of
+    the individual processes. Both contain the region, so accepting the candidates which
+    are below `scale` for every process gives uniformly distributed points; drawing from
+    an ellipsoid is much more efficient than drawing from the box in many dimensions.
 
-    # coarse_scan.fit()
-    maxes = {}
-    mins = {}
+    Parameters
+    ----------
+        coefficients : tuple of str
+            The coefficients to be sampled.
+        coarse_scan : CrossSectionScan
+            The fitted scan to use for evaluating NP / SM.
+        scale : float
+            The maximum ratio of the (cross section)_NP / (cross section)_SM.
+        count : int
+            The number of points to return.
+        processes : list of str
+            The processes to constrain the region with (default: all of them).
+        batch_size : int
+            The number of candidates to draw at once.
+        max_batches : int
+            Give up after drawing this many batches.
+        limit : float
+            The largest magnitude to allow for any coefficient value.
+        seed : int
+            Seed for the random number generator (default: use the global numpy state).
 
-    start = time.time()
-    for column, coefficient in enumerate(coefficients):
-        coefficient_sets = [x for x in coarse_scan.points.keys() if coefficient in x]
-        if len(coefficient_sets) == 0:
-            raise RuntimeError('coarse scan is missing {}'.format(coefficient))
-        coefficient_set = sorted(coefficient_sets, key=lambda x: len(x))[-1]
-        for process in coarse_scan.points[coefficient_set]:
-            s0, s1, s2 = coarse_scan.construct(process, coefficient)
-            def f(point):
-                return scale - (s0 + s1 * point + s2 * point * point)
-            low = scipy.optimize.fsolve(f, [-4 * np.pi ** 2])[0]
-            high = scipy.optimize.fsolve(f, [4 * np.pi ** 2])[0]
-
-            if column in maxes:
-                maxes[column] = min(maxes[column], high)
-                mins[column] = max(mins[column], low)
-            else:
-                maxes[column] = high
-                mins[column] = low
-
-    # for process in coarse_scan.points[coefficient_set]:
-    #     num_sampled_points = 1000000
-    #     sampled_points = np.zeros((num_sampled_points, len(coefficients)))
-    #     for i in range(num_sampled_points):
-    #         point = []
-    #         for column, coefficient in enumerate(coefficients):
-    #             point += [np.random.uniform(mins[column], maxes[column])]
-    #         sampled_points[i] = np.array([point])
-
-    #     scales = coarse_scan.evaluate(coefficients, sampled_points, process).ravel()
-    #     sampled_points = sampled_points[scales < scale]
-    #     print('now len is ', process, coefficients, len(sampled_points))
-
-    #     for column, low in enumerate(np.amin(sampled_points, axis=0)):
-    #         mins[column] = max(mins[column], low)
-    #     for column, high in enumerate(np.amax(sampled_points, axis=0)):
-    #         maxes[column] = min(maxes[column], high)
-    # print('got bounds for {} with {} points in {:.1f} seconds'.format(str(coefficients), len(sampled_points), time.time() - start))
-    return mins, maxes
+    Returns
+    ----------
+        points : np.ndarray
+            The sampled points, with one row per point.
+        acceptance : float
+            The fraction of candidates which were accepted.
+    """
+    random = np.random if seed is None else np.random.RandomState(seed)
+    processes = constraint_processes(coefficients, coarse_scan, processes)
+    dim = len(coefficients)
+    mins, maxes = get_bounds(coefficients, coarse_scan, scale, surface=True, processes=processes, limit=limit)
+    low = np.array([mins[i] for i in range(dim)])
+    high = np.array([maxes[i] for i in range(dim)])
+
+    # log volume of the unit ball
+    log_ball = 0.5 * dim * np.log(np.pi) - scipy.special.gammaln(0.5 * dim + 1)
+    log_volume = np.sum(np.log(high - low))
+    ellipsoid = None
+    for process in processes:
+        s0, b, Q = quadratic_form(coarse_scan.construct(process, coefficients), dim)
+        try:
+            L = np.linalg.cholesky(Q)
+        except np.linalg.LinAlgError:
+            continue
+        center = -0.5 * np.linalg.solve(Q, b)
+        k = scale - s0 + np.dot(center, np.dot(Q, center))
+        log_ellipsoid = log_ball + 0.5 * dim * np.log(k) - np.sum(np.log(np.diag(L)))
+        if log_ellipsoid < log_volume:
+            log_volume = log_ellipsoid
+            # x = center + sqrt(k) L^-T y maps the unit ball onto the ellipsoid
+            ellipsoid = (center, np.sqrt(k) * np.linalg.inv(L))
+
+    accepted = []
+    total = 0
+    drawn = 0
+    for batch in range(max_batches):
+        if ellipsoid is None:
+            candidates = random.uniform(low, high, (batch_size, dim))
+        else:
+            center, transform = ellipsoid
+            directions = random.standard_normal((batch_size, dim))
+            directions /= np.sqrt(np.sum(directions ** 2, axis=1))[:, np.newaxis]
+            radii = random.uniform(0, 1, (batch_size, 1)) ** (1. / dim)
+            candidates = center + np.dot(directions * radii, transform)
+        drawn += batch_size
+
+        inside = np.all(np.abs(candidates) <= limit, axis=1)
+        if len(processes) > 0:
+            inside &= np.all(coarse_scan.evaluate_many(coefficients, candidates, processes) < scale, axis=1)
+        accepted.append(candidates[inside])
+        total += np.count_nonzero(inside)
+        if total >= count:
+            break
+
+    acceptance = total / float(drawn)
+    print('sampled {} points for {} from {} in {} batches with acceptance {:.3g}'.format(
+        min(total, count), str(tuple(coefficients)), 'box' if ellipsoid is None else 'ellipsoid', batch + 1, acceptance))
+    if total < count:
+        raise RuntimeError('only found {} of {} points after {} batches'.format(total, count, max_batches))
+
+    return np.vstack(accepted)[:count], acceptance
 
 # def get_bounds(coefficients, coarse_scan, scale, interpolate_numvalues, step=0.2, min_value=1e-11):
 #     """Return a grid of points with dimensionality
@@ -616,7 +1178,8 @@ def get_bounds(coefficients, coarse_scan, scale):
 #     print('got bounds for {} in {:.1f} seconds'.format(str(coefficients), time.time() - start))
 #     return mins, maxes
 
-def setup_model(base, madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards, point):
+def setup_model(base, madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards, point,
+        workdir=None):
     """
     Setup the NP model and update the coefficient value
 
@@ -641,34 +1204,33 @@ def setup_model(base, madgraph, np_model, np_param_path, coefficients, process_c
             and the parameter card pointed to by np_param_path).
         point : np.ndarray
             The values to set the coefficients to.
+        workdir : str
+            The directory to set up the model in (default: the working directory).
+            The working directory is not changed, so several models can be set up
+            concurrently in different directories.
 
     Returns
     ----------
         outdir : str
-            The output madgraph processing directory.
+            The output madgraph processing directory, relative to `workdir`.
     """
+    workdir = os.getcwd() if workdir is None else os.path.abspath(workdir)
+    base = os.path.abspath(base)
 
-    subprocess.call(['tar', 'xaf', os.path.join(base, madgraph)])
-    subprocess.call(['tar', 'xaf', os.path.join(base, np_model), '--directory=models'])
+    subprocess.call(['tar', 'xaf', os.path.join(base, madgraph)], cwd=workdir)
+    subprocess.call(['tar', 'xaf', os.path.join(base, np_model), '--directory=models'], cwd=workdir)
 
     if not np_param_path.startswith('models'):
         np_param_path = os.path.join('models', np_param_path)
-    with open(np_param_path) as f:
-        np_params = f.readlines()
+    set_coefficients(os.path.join(workdir, np_param_path), coefficients, point)
 
-    with open(np_param_path, 'w') as f:
-        for line in np_params:
-            for coefficient, value in zip(coefficients, point):
-                line = re.sub('\d*.\d00000.*\# {0} '.format(coefficient), '{0} # {1}'.format(value, coefficient), line)
-
-            f.write(line)
-
-    subprocess.check_output(['python', os.path.join('bin', 'mg5_aMC'), '-f', os.path.join(base, process_card)])
+    subprocess.check_output(['python', os.path.join('bin', 'mg5_aMC'), '-f', os.path.join(base, process_card)],
+                            cwd=workdir)
 
     with open(os.path.join(base, process_card)) as f:
         card = f.read()
     outdir = re.search('\noutput (\S*)', card).group(1)
-    carddir = os.path.join(outdir, 'Cards')
+    carddir = os.path.join(workdir, outdir, 'Cards')
 
     shutil.copy(os.path.join(base, cards, 'run_card.dat'), carddir)
     shutil.copy(os.path.join(base, cards, 'grid_card.dat'), carddir)
@@ -716,7 +1278,68 @@ def setup_sandbox(madgraph, np_model, np_param_path, coefficients, process_card,
     print('sandbox is ', sandbox)
     print('outdir is ', outdir)
 
-def get_cross_section(madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards, point):
+def set_coefficients(param_card, coefficients, point):
+    """Set the coefficient values in a parameter card
+
+    Parameters
+    ----------
+        param_card : str
+            Path to the parameter card, which is rewritten in place.
+        coefficients : tuple of str
+            Coefficients to set.
+        point : np.ndarray
+            The values to set the coefficients to.
+    """
+    ParamCard.load(param_card).write(param_card, dict(zip(coefficients, point)))
+
+
+class ProcessCache(object):
+    """Madgraph process directories which are reused between points
+
+    Only the parameter card differs between points of the same process, so the
+    process directory is generated once per combination of inputs (see `setup_model`)
+    and only the parameter card is rewritten for each point, from a template compiled
+    when the directory is generated.
+    """
+
+    def __init__(self, basedir=None):
+        self.sandbox = TempDir(prefix='processes', basedir=None if basedir is None else os.path.abspath(basedir))
+        self.outdirs = {}
+        self.templates = {}
+
+    def setup(self, base, madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards, point):
+        """Return the process directory for `process_card` with the coefficients set to `point`
+
+        The arguments are the same as for `setup_model`.
+        """
+        base = os.path.abspath(base)
+        key = tuple([os.path.join(base, x) for x in (madgraph, np_model, process_card, cards)] +
+                    [np_param_path, tuple(coefficients), cores, events])
+        if key not in self.outdirs:
+            sandbox = os.path.join(self.sandbox.name, str(len(self.outdirs)))
+            os.makedirs(sandbox)
+            # Madgraph removes parameters which are zero in the restriction card and merges
+            # parameters with identical values, so generate with distinct, non-zero values
+            placeholder = [0.1 + 0.01 * i for i in range(len(coefficients))]
+            outdir = setup_model(base, madgraph, np_model, np_param_path, coefficients, process_card, cores,
+                                 events, cards, placeholder, workdir=sandbox)
+            self.outdirs[key] = os.path.join(sandbox, outdir)
+            param_card = os.path.join(self.outdirs[key], 'Cards', 'param_card.dat')
+            self.templates[key] = ParamCard.load(param_card).template(coefficients)
+
+        outdir = self.outdirs[key]
+        for run in glob.glob(os.path.join(outdir, 'Events', '*')):
+            if os.path.isdir(run):
+                shutil.rmtree(run)
+            else:
+                os.remove(run)
+        self.templates[key].write(os.path.join(outdir, 'Cards', 'param_card.dat'), point)
+
+        return outdir
+
+
+def get_cross_section(madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards, point,
+        cache=None, log=None):
     """
     Update the Wilson coefficient value, run Madgraph, and return the calculated
     cross section.
@@ -740,55 +1363,448 @@ def get_cross_section(madgraph, np_model, np_param_path, coefficients, process_c
             and the parameter card pointed to by np_param_path).
         point : np.ndarray
             The values to set the coefficients to.
+        cache : ProcessCache
+            If given, reuse the process directory from previous points instead of generating it.
+        log : str
+            If given, append the Madgraph output to this gzipped file.
     """
     start = os.getcwd()
-    with TempDir() as sandbox:
-        os.chdir(sandbox)
+    if cache is not None:
+        outdir = cache.setup(start, madgraph, np_model, np_param_path, coefficients, process_card, cores, events,
+                             cards, point)
+        cross_section, err, _ = run_generate_events(outdir, log)
+    else:
+        with TempDir() as sandbox:
+            outdir = setup_model(start, madgraph, np_model, np_param_path, coefficients, process_card, cores,
+                                 events, cards, point, workdir=sandbox)
+            cross_section, err, _ = run_generate_events(os.path.join(sandbox, outdir), log)
 
-        outdir = setup_model(start, madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards, point)
+    return cross_section, err
 
-        output = subprocess.check_output(['./{}/bin/generate_events'.format(outdir), '-f'])
-        m = re.search("Cross-section :\s*(.*) \+\- (.*) pb", output)
-        os.chdir(start)
-        print(output)
+def run_generate_events(outdir, log=None):
+    """Run `generate_events` in a process directory and parse its output as it is written
+
+    The output is not kept in memory. Each line is checked for the cross section, the
+    start of the phases in `MADGRAPH_PHASES`, and the failures in `MADGRAPH_FAILURES`,
+    which stop the run right away.
+
+    Parameters
+    ----------
+        outdir : str
+            Absolute path to the process directory.
+        log : str
+            If given, append the output to this gzipped file.
+
+    Returns
+    ----------
+        cross_section : float
+        err : float
+        timings : collections.OrderedDict
+            The time spent in each phase, in seconds.
+    """
+    timings = collections.OrderedDict()
+    phase = 'setup'
+    phase_start = time.time()
+    result = None
+    failure = None
+
+    out = gzip.open(log, 'ab') if log is not None else None
+    # run Madgraph in its own process group, so the jobs it starts can be stopped with it; this is
+    # called from the threads of `MadgraphRunner`, where preexec_fn is unsafe, so only fall back to
+    # it where start_new_session is not available
+    session = {'start_new_session': True} if sys.version_info[0] >= 3 else {'preexec_fn': os.setsid}
+    job = subprocess.Popen([os.path.join(outdir, 'bin', 'generate_events'), '-f'], cwd=os.path.dirname(outdir),
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, **session)
+    try:
+        for line in iter(job.stdout.readline, ''):
+            if out is not None:
+                out.write(line if isinstance(line, bytes) else line.encode('utf8'))
+            m = MADGRAPH_CROSS_SECTION.search(line)
+            if m:
+                result = float(m.group(1)), float(m.group(2))
+            for name, pattern in MADGRAPH_PHASES:
+                if name != phase and pattern.search(line):
+                    timings[phase] = timings.get(phase, 0.) + time.time() - phase_start
+                    phase, phase_start = name, time.time()
+            if any(pattern.search(line) for pattern in MADGRAPH_FAILURES):
+                failure = line.strip()
+                kill_process_group(job)
+                break
+    except BaseException:
+        # do not wait for a run whose output is no longer read
+        kill_process_group(job)
+        raise
+    finally:
+        job.stdout.close()
+        job.wait()
+        if out is not None:
+            out.close()
+    timings[phase] = timings.get(phase, 0.) + time.time() - phase_start
+
+    if failure is not None:
+        raise RuntimeError('mg calculation failed: {}'.format(failure))
+    if job.returncode != 0:
+        raise RuntimeError('mg calculation failed with exit code {}'.format(job.returncode))
+    if result is None:
+        raise RuntimeError('mg calculation failed')
+    print('cross section {} +- {} pb, '.format(*result) +
+          ', '.join('{} {:.0f}s'.format(name, seconds) for name, seconds in timings.items()))
+
+    return result[0], result[1], timings
+
+
+def kill_process_group(job):
+    """Stop a job started in its own process group, and the jobs it started
+    """
+    try:
+        os.killpg(job.pid, signal.SIGKILL)
+    except OSError:
+        # the job has already exited
+        pass
+
+
+class MadgraphRunner(object):
+    """Calculate cross sections for several points concurrently on one node
+
+    The per-core efficiency of Madgraph drops with the number of cores per run, so
+    it is faster to split the available cores over several concurrent runs with
+    fewer cores each. Every concurrent run has its own process directory (see
+    `ProcessCache`), which is generated when it is first needed. Process directories
+    are generated concurrently as well; paths are resolved before the runs start, and
+    the working directory is never changed.
+    """
+
+    def __init__(self, cores, jobs, basedir=None):
+        """
+        Parameters
+        ----------
+            cores : int
+                Number of cores to use in total.
+            jobs : int
+                Number of points to calculate concurrently.
+            basedir : str
+                Directory to generate the process directories in.
+        """
+        self.jobs = max(1, min(jobs, cores))
+        self.cores = max(1, cores // self.jobs)
+        self.caches = [ProcessCache(basedir) for _ in range(self.jobs)]
+        self.failures = {}
+        # guards the queue of points and the results
+        self.lock = threading.Lock()
+
+    def run(self, madgraph, np_model, np_param_path, coefficients, process_card, events, cards, points, logdir=None,
+            callback=None):
+        """
+        Calculate the cross sections for a set of points.
+
+        The arguments are the same as for `get_cross_section`, except that the
+        number of cores is set by the runner, and `points` has one row per point.
+        Points which fail are skipped; their errors are kept in `failures`, by row.
+        If `logdir` is given, the Madgraph output of each point is written to a
+        gzipped log in it. If `callback` is given, it is called with the row, point,
+        cross section and error of each point as soon as it succeeds.
+
+        Returns
+        ----------
+            CrossSectionScan
+                The cross sections of the points which succeeded, in the order of `points`.
+        """
+        points = np.array(points, dtype=float).reshape(-1, len(coefficients))
+        process = process_card.split('/')[-1].replace('.dat', '')
+        base = os.getcwd()
+        madgraph, np_model, process_card, cards = [os.path.abspath(x) for x in (madgraph, np_model, process_card, cards)]
+        if logdir is not None:
+            logdir = os.path.abspath(logdir)
+        tasks = iter(range(len(points)))
+        results = {}
+        self.failures = {}
+
+        def work(cache):
+            while True:
+                with self.lock:
+                    try:
+                        index = next(tasks)
+                    except StopIteration:
+                        return
+                try:
+                    outdir = cache.setup(base, madgraph, np_model, np_param_path, coefficients, process_card,
+                                         self.cores, events, cards, points[index])
+                except Exception as e:
+                    print('point {} failed: {}'.format(index, e))
+                    with self.lock:
+                        self.failures[index] = e
+                    continue
+
+                start = time.time()
+                log = None if logdir is None else os.path.join(logdir, 'point_{}.log.gz'.format(index))
+                try:
+                    cross_section, err, _ = run_generate_events(outdir, log)
+                    print('point {}: {} +- {} pb ({:.0f}s)'.format(index, cross_section, err, time.time() - start))
+                    with self.lock:
+                        results[index] = cross_section, err
+                        if callback is not None:
+                            callback(index, points[index], cross_section, err)
+                except Exception as e:
+                    print('point {} failed: {}'.format(index, e))
+                    with self.lock:
+                        self.failures[index] = e
+
+        threads = [threading.Thread(target=work, args=(cache,)) for cache in self.caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        scan = CrossSectionScan()
+        for index in sorted(results):
+            scan.add(points[index], results[index][0], results[index][1], process, coefficients)
+
+        return scan
+
+class ScanCheckpoint(object):
+    """Append-only record of the points of a scan job which are done
+
+    Each point is written to the file as soon as it has been calculated, so a job
+    which is restarted can skip the points it already calculated. A line which was
+    only partially written when a job was interrupted is discarded.
+
+    The first line of the file describes what the points were calculated for. A file
+    with a different description (left over from another job, or from a job with
+    different arguments) is not resumed from, but moved aside.
+    """
+
+    def __init__(self, fn, description=None):
+        """
+        Parameters
+        ----------
+            fn : str
+                The file to record points in.
+            description : dict
+                Everything which defines the points of the job, such as the process,
+                the coefficients, and the arguments of the grid or design.
+        """
+        self.fn = fn
+        self.results = {}
+        self.header = None
+        if description is not None:
+            self.header = '# ' + ' '.join('{}={}'.format(key, description[key]) for key in sorted(description))
+
+        lines = []
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                # everything after the last newline was not completely written
+                lines = f.read().split('\n')[:-1]
+        if len(lines) > 0 and self.header is not None and lines[0] != self.header:
+            print('WARNING: {} was written for different points ({}), moving it to {}.stale and starting over'.format(
+                fn, lines[0].lstrip('# '), fn))
+            os.rename(fn, fn + '.stale')
+            lines = []
+        records = [line for line in lines if not line.startswith('#')]
+
+        with open(fn, 'w') as f:
+            if self.header is not None:
+                f.write(self.header + '\n')
+            f.write(''.join(line + '\n' for line in records))
+        for line in records:
+            values = line.split()
+            self.results[int(values[0])] = (np.array(values[3:], dtype=float), float(values[1]), float(values[2]))
+        if len(records) > 0:
+            print('resuming from {} with {} points done'.format(fn, len(self.results)))
+
+    def __contains__(self, index):
+        return index in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def record(self, index, point, cross_section, err):
+        with open(self.fn, 'a') as f:
+            values = [cross_section, err] + list(point)
+            f.write('{} {}\n'.format(index, ' '.join('{:.17g}'.format(x) for x in values)))
+            f.flush()
+            os.fsync(f.fileno())
+        self.results[index] = (np.array(point, dtype=float), cross_section, err)
+
+    def missing(self, indices):
+        """Return the `indices` which are not done
+        """
+        return [index for index in indices if index not in self.results]
+
+    def scan(self, process, coefficients, indices=None):
+        """Return the points which are done as a CrossSectionScan, ordered by index
+
+        If `indices` is given, only those points are included.
+        """
+        scan = CrossSectionScan()
+        for index in sorted(self.results):
+            if indices is not None and index not in indices:
+                continue
+            point, cross_section, err = self.results[index]
+            scan.add(point, cross_section, err, process, coefficients)
+
+        return scan
 
-        try:
-            return float(m.group(1)), float(m.group(2))
-        except (TypeError, AttributeError):
-            raise RuntimeError('mg calculation failed')
 
 def get_coefficient_ids(lines, coefficients):
-    coefficient_ids = {}
-    for line in lines:
-        if 'Block' in line:
-            current_block = line.split()[-1].strip()
-        m = re.search('(\d*) [\d.e\-\+]* # (\S*)', line)
-        if m:
-            id, coef = m.groups()
-            if coef in coefficients:
-                model_block = current_block
-                coefficient_ids[coef] = id
-    return coefficient_ids, model_block
+    coefficient_ids, model_block = ParamCard(lines).ids(coefficients)
+    return dict((coef, str(id)) for coef, id in coefficient_ids.items()), model_block
 
 def write_reweight_card(param_card, reweight_card, numpoints, coefficients, mins, maxes):
     """Write a reweight card for Madgraph
 
     This should be good-to-go for multidimensions
     """
-    with open(param_card, 'r') as f:
-        coefficient_ids, model_block = get_coefficient_ids(f.readlines(), coefficients)
+    mins = np.array([mins[column] for column in range(len(coefficients))])
+    maxes = np.array([maxes[column] for column in range(len(coefficients))])
+    points = np.random.uniform(mins, maxes, (numpoints, len(coefficients)))
+
+    write_reweight_points(param_card, reweight_card, coefficients, points)
+
+def write_reweight_points(param_card, reweight_card, coefficients, points):
+    """Write a reweight card for Madgraph with one launch block per point
+
+    Parameters
+    ----------
+        param_card : str
+            Parameter card to look up the block and ids of the coefficients in.
+        reweight_card : str
+            The reweight card to write.
+        coefficients : tuple of str
+            The coefficients corresponding to the columns of `points`.
+        points : np.ndarray
+            The points to reweight to, with one row per point.
+    """
+    coefficient_ids, model_block = ParamCard.load(param_card).ids(coefficients)
     print('ids ', coefficient_ids)
 
+    lines = ['set {} {} '.format(model_block, coefficient_ids[coef]) for coef in coefficients]
+    template = CardTemplate(['launch\n' + lines[0]] + ['\n' + line for line in lines[1:]] + ['\n'])
     with open(reweight_card, 'w') as f:
-        for _ in range(numpoints):
-            f.write('launch\n')
-            for column, coef in enumerate(coefficients):
-                coef_value = np.random.uniform(mins[column], maxes[column])
-                f.write('set {} {} {:.6f}\n'.format(model_block, coefficient_ids[coef], coef_value))
+        f.write(template.render_many(points))
+
+def reweighted_cross_sections(lhe, cross_section, err):
+    """Calculate the cross section of each reweighted point in an LHE file
+
+    The cross section of point k is the cross section of the generated sample scaled
+    by sum(w_k) / sum(w_0), where w_k are the event weights for point k and w_0 the
+    original event weights. The error combines the error of the generated sample with
+    the statistical error on the ratio.
+
+    Parameters
+    ----------
+        lhe : str
+            LHE file with reweighted events (optionally gzipped).
+        cross_section : float
+            The cross section of the generated sample.
+        err : float
+            The error on `cross_section`.
+
+    Returns
+    ----------
+        cross_sections : np.ndarray
+            The cross section of each reweighted point, in the order of the reweight card.
+        errs : np.ndarray
+            The error on each cross section.
+    """
+    reader = lheReader(lhe)
+    ids = [weight.attrib.get('id') for weight in reader.header.iter('weight')]
+    statistics = reader.getWeightStatistics([i for i in ids if i.startswith('rwgt')])
+    ratios, ratio_errs = statistics.ratios()
+    ratios, ratio_errs = ratios[1:], ratio_errs[1:]
+    cross_sections = cross_section * ratios
+    errs = np.sqrt((err * ratios) ** 2 + (cross_section * ratio_errs) ** 2)
+
+    return cross_sections, errs
+
+def get_cross_sections_reweighted(madgraph, np_model, np_param_path, coefficients, process_card, cores, events, cards,
+        points, reference=None, cache=None, log=None):
+    """
+    Generate one sample at a reference point and calculate the cross sections for all
+    points from the Madgraph reweighting weights.
 
-def parse_lhe_weights(lhe, coefficients):
+    Parameters
+    ----------
+        madgraph : str
+            Tarball containing madgraph.
+        np_model : str
+            Tarball containing NP model
+        np_param_path : str
+            Path (relative to the unpacked madgraph tarball) to the NP parameter card.
+        coefficients : tuple of str
+            Coefficients to scan.
+        cores : int
+            Number of cores to use.
+        events : int
+            Number of events to generate at the reference point.
+        cards : str
+            Path to the cards directory (must contain run_card.dat, grid_card.dat, me5_configuration.txt
+            and the parameter card pointed to by np_param_path).
+        points : np.ndarray
+            The points to calculate, with one row per point.
+        reference : np.ndarray
+            The point to generate events at. The phase space of the sample should cover that
+            of all points, so the default is the point farthest from the SM.
+        cache : ProcessCache
+            If given, reuse the process directory from previous calls instead of generating it.
+        log : str
+            If given, append the Madgraph output to this gzipped file.
+
+    Returns
+    ----------
+        CrossSectionScan
+            The cross sections and errors of `points`.
+    """
+    points = np.array(points, dtype=float).reshape(-1, len(coefficients))
+    if reference is None:
+        reference = points[np.argmax(np.sum(points ** 2, axis=1))]
+    process = process_card.split('/')[-1].replace('.dat', '')
+
+    # coefficients which are zero when the process is generated are removed from the
+    # model and cannot be reweighted, which the process cache takes care of
+    temporary = cache is None
+    if temporary:
+        cache = ProcessCache()
+    outdir = cache.setup(os.getcwd(), madgraph, np_model, np_param_path, coefficients, process_card, cores, events,
+                         cards, reference)
+
+    carddir = os.path.join(outdir, 'Cards')
+    reweight_card = os.path.join(carddir, 'reweight_card.dat')
+    write_reweight_points(os.path.join(carddir, 'param_card.dat'), reweight_card, coefficients, points)
+    with open(os.path.join(carddir, 'me5_configuration.txt')) as f:
+        configured = MADGRAPH_PATH_SETTING.search(f.read()) is not None
+    if not configured:
+        # the reweighting module needs to find the madgraph installation the process was generated with
+        with open(os.path.join(carddir, 'me5_configuration.txt'), 'a') as f:
+            print('mg5_path = {}'.format(os.path.dirname(outdir)), file=f)
+
+    try:
+        cross_section, err, _ = run_generate_events(outdir, log)
+
+        lhe = glob.glob(os.path.join(outdir, 'Events', '*', 'unweighted_events.lhe*'))
+        if len(lhe) == 0:
+            raise RuntimeError('mg calculation did not produce any events')
+        cross_sections, errs = reweighted_cross_sections(sorted(lhe)[-1], cross_section, err)
+        if len(cross_sections) != len(points):
+            raise RuntimeError('expected {} reweighted points but found {}'.format(len(points), len(cross_sections)))
+    finally:
+        # the process directory may be reused for points which should not be reweighted
+        os.remove(reweight_card)
+        if temporary:
+            cache.sandbox.dissolve()
+
+    result = CrossSectionScan()
+    result.add(points, cross_sections, errs, process, coefficients)
+
+    return result
+
+
+def parse_lhe_weights(lhe, coefficients, cache=False, workers=1):
     """Parse weights from LHE file
 
+    If `cache` is set, the weights are read from a binary cache of the LHE file
+    (see `lheReader`) which is created on the first call. Uncompressed files are
+    read in parallel by `workers` processes.
+
     Returns
     -------
     numpy.ndarray
@@ -800,14 +1816,13 @@ def parse_lhe_weights(lhe, coefficients):
     """
     print('parsing {}'.format(lhe))
 
-    tree = ET.parse(lhe)
-    root = tree.getroot()
-    points = []
-    slha = list(root.iter('slha'))[0]
+    reader = lheReader(lhe, cache=cache)
+    slha = reader.header.find('slha')
     coefficient_ids, model_block = get_coefficient_ids(slha.text.splitlines(), coefficients)
-    num_points = len(list(root.iter('weight')))
+    reweightings = list(reader.header.iter('weight'))
+    num_points = len(reweightings)
     points = np.zeros((num_points, len(coefficients)))
-    for i, weight in enumerate(root.iter('weight')):
+    for i, weight in enumerate(reweightings):
         values = dict(re.findall('param_card {} (\d*) ([\d.e\-\+]*)'.format(model_block), weight.text))
         for j, c in enumerate(coefficients):
             try:
@@ -820,13 +1835,8 @@ def parse_lhe_weights(lhe, coefficients):
             if id == coefficient_ids[c]:
                 start_values[i] = value
 
-    num_events = len(root[2:])
-    print('will process {} points in {} events'.format(num_points, num_events))
-    weights = np.zeros((num_events, num_points))
-    for i, event in enumerate(root[2:]):
-        weights[i] = np.array([float(wgt.text) for wgt in event.iter('wgt')])
-        if i % 10000 == 0:
-            print('completed {} / {} events'.format(i, num_events))
+    _, _, weights = reader.getWeightArray([weight.attrib.get('id') for weight in reweightings], workers=workers)
+    print('processed {} points in {} events'.format(num_points, len(weights)))
 
     return start_values, points, weights
 
@@ -0,0 +1,258 @@
+from __future__ import print_function
+import abc
+
+import numpy as np
+
+from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan
+from NPFitProduction.NPFitProduction.utils import IndexedPoints
+
+
+def model_terms(dim):
+    """Return the number of fit constants for `dim` coefficients, which is the
+    minimum number of points needed for a fit (see `CrossSectionScan.fit`)
+    """
+    return 1 + 2 * dim + dim * (dim - 1) // 2
+
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def max_correlation(strata):
+    """Return the largest absolute correlation between the columns of `strata`
+    """
+    if strata.shape[1] < 2 or len(strata) < 3:
+        return 0.
+    correlation = np.corrcoef(strata, rowvar=False)
+    return np.abs(correlation[~np.eye(len(correlation), dtype=bool)]).max()
+
+
+def uniform_hash(seed, rows, columns):
+    """Return uniform values in [0, 1) which depend only on (seed, row, column)
+
+    This is a counter-based generator (splitmix64), so any row of a design can be
+    drawn without drawing the rows before it.
+
+    Parameters
+    ----------
+        seed : int
+        rows : array of int
+        columns : array of int
+            Broadcast against `rows`.
+    """
+    with np.errstate(over='ignore'):
+        x = (np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+             + np.asarray(rows, dtype=np.uint64) * np.uint64(0xBF58476D1CE4E5B9)
+             + np.asarray(columns, dtype=np.uint64) * np.uint64(0x94D049BB133111EB))
+        x = x ^ (x >> np.uint64(30))
+        x = x * np.uint64(0xBF58476D1CE4E5B9)
+        x = x ^ (x >> np.uint64(27))
+        x = x * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+
+    return (x >> np.uint64(11)).astype(float) / float(1 << 53)
+
+
+class Design(IndexedPoints):
+    """A set of points inside the box mins < c_j < maxes, which can be indexed like an array
+
+    Index 0 is always the SM point, which is needed to calculate the scaling. Points
+    depend only on the bounds, size, seed, and index, so a job can calculate point `i`
+    by itself.
+    """
+
+    def __init__(self, mins, maxes, size, seed=0):
+        """
+        Parameters
+        ----------
+            mins : dict or list
+                The lower bound of each coefficient, by column (see `get_bounds`).
+            maxes : dict or list
+                The upper bound of each coefficient, by column.
+            size : int
+                The number of points, including the SM point. Defaults to twice the
+                number of fit constants, and must be at least the number of fit constants.
+            seed : int
+        """
+        terms = model_terms(len(mins))
+        if size is None:
+            size = 2 * terms
+        if size < terms:
+            raise ValueError('{}d fit requires at least {} points, got {}'.format(len(mins), terms, size))
+        self.mins = np.array([mins[column] for column in range(len(mins))], dtype=float)
+        self.maxes = np.array([maxes[column] for column in range(len(maxes))], dtype=float)
+        self.dim = len(self.mins)
+        self.size = int(size)
+        self.seed = int(seed)
+
+    def rows(self, indices):
+        res = np.zeros((len(indices), self.dim))
+        nonzero = indices > 0
+        res[nonzero] = self.mins + self.unit(indices[nonzero]) * (self.maxes - self.mins)
+
+        return res
+
+    @abc.abstractmethod
+    def unit(self, indices):
+        """Return the points at `indices` (all > 0) in the unit cube
+        """
+
+
+class LatinHypercube(Design):
+    """A Latin hypercube design
+
+    Each axis is divided into `size - 1` strata, and each stratum contains exactly
+    one of the non-SM points; the position within the stratum is random. The strata
+    of each axis are a seeded permutation. Of several permutations, the one with the
+    smallest correlation between axes is kept, so that the quadratic model is well
+    conditioned.
+
+    Above `explicit_limit` strata the permutations are not stored: the stratum of
+    point k along axis j is (a_j k + b_j) mod (size - 1), with a_j coprime to size - 1,
+    so it can be calculated by itself. The multipliers a_j are distinct, and no two
+    add up to size - 1, which would give identical or mirrored axes.
+    """
+
+    explicit_limit = 2 ** 20
+
+    def __init__(self, mins, maxes, size=None, seed=0, attempts=20):
+        """
+        Parameters
+        ----------
+            attempts : int
+                The number of permutations to choose the least correlated one from.
+        """
+        super(LatinHypercube, self).__init__(mins, maxes, size, seed)
+        strata = self.size - 1
+        random = np.random.RandomState(self.seed)
+        self.permutations = None
+        self.multipliers = None
+        self.offsets = None
+
+        best = None
+        for _ in range(attempts):
+            if strata <= self.explicit_limit:
+                permutations = np.column_stack([random.permutation(strata) for _ in range(self.dim)])
+                correlation = max_correlation(permutations)
+            else:
+                multipliers = self.draw_multipliers(random, strata)
+                offsets = random.randint(0, strata, self.dim).astype(np.int64)
+                sample = random.randint(0, strata, 10000).astype(np.int64)
+                correlation = max_correlation((multipliers * sample[:, None] + offsets) % strata)
+            if best is None or correlation < best:
+                best = correlation
+                if strata <= self.explicit_limit:
+                    self.permutations = permutations
+                else:
+                    self.multipliers, self.offsets = multipliers, offsets
+        self.correlation = best
+
+    def draw_multipliers(self, random, strata):
+        multipliers = []
+        while len(multipliers) < self.dim:
+            a = int(random.randint(1, strata))
+            if gcd(a, strata) == 1 and a not in multipliers and strata - a not in multipliers:
+                multipliers.append(a)
+        return np.array(multipliers, dtype=np.int64)
+
+    def unit(self, indices):
+        strata = self.size - 1
+        k = np.asarray(indices, dtype=np.int64) - 1
+        columns = np.arange(self.dim)
+        if self.permutations is not None:
+            stratum = self.permutations[k]
+        else:
+            stratum = (self.multipliers * k[:, None] + self.offsets) % strata
+        jitter = uniform_hash(self.seed, k[:, None], columns[None, :])
+
+        return (stratum + jitter) / strata
+
+
+class DOptimalDesign(Design):
+    """A D-optimal design for the quadratic model of `CrossSectionScan.model`
+
+    The points maximize det(A^T A), where A is the model matrix of the design,
+    which minimizes the volume of the confidence region of the fit constants. They
+    are chosen from a Latin hypercube of candidates by Fedorov's exchange algorithm,
+    keeping the SM point fixed. Unlike `LatinHypercube`, the whole design has to
+    be calculated to get any point; it is calculated once on first access.
+    """
+
+    def __init__(self, mins, maxes, size=None, seed=0, candidates=None, passes=10):
+        """
+        Parameters
+        ----------
+            size : int
+                The number of points, including the SM point. Defaults to twice the
+                number of fit constants.
+            candidates : int
+                The number of candidate points. Defaults to 50 times the number of fit constants.
+            passes : int
+                The maximum number of passes over the design exchanging points.
+        """
+        super(DOptimalDesign, self).__init__(mins, maxes, size, seed)
+        terms = model_terms(self.dim)
+        self.candidates = LatinHypercube(mins, maxes, (candidates or 50 * terms) + 1, seed)
+        self.passes = passes
+        self.design = None
+
+    def unit(self, indices):
+        if self.design is None:
+            self.design = self.optimize()
+        return self.design[indices - 1]
+
+    def optimize(self):
+        # work in coordinates scaled to |c_j| <= 1: the optimal design does not change,
+        # but the model matrix is much better conditioned
+        norm = np.maximum(np.abs(self.mins), np.abs(self.maxes))
+        norm[norm == 0] = 1.
+        pool = self.candidates.unit(np.arange(1, len(self.candidates)))
+        pool_rows = CrossSectionScan.model((self.mins + pool * (self.maxes - self.mins)) / norm)
+        sm = CrossSectionScan.model(np.zeros((1, self.dim)))[0]
+        terms = len(sm)
+
+        # greedily add the candidate with the largest predicted variance
+        information = np.outer(sm, sm) + 1e-8 * np.identity(terms)
+        chosen = []
+        available = np.ones(len(pool), dtype=bool)
+        for _ in range(self.size - 1):
+            inverse = np.linalg.inv(information)
+            variances = np.sum(np.dot(pool_rows, inverse) * pool_rows, axis=1)
+            variances[~available] = -np.inf
+            best = np.argmax(variances)
+            chosen.append(best)
+            available[best] = False
+            information += np.outer(pool_rows[best], pool_rows[best])
+        information -= 1e-8 * np.identity(terms)
+
+        # exchange design points with candidates while that increases the determinant
+        for _ in range(self.passes):
+            improved = False
+            for i in range(len(chosen)):
+                inverse = np.linalg.pinv(information)
+                row = pool_rows[chosen[i]]
+                d_i = np.dot(row, np.dot(inverse, row))
+                cross = np.dot(pool_rows, np.dot(inverse, row))
+                d_j = np.sum(np.dot(pool_rows, inverse) * pool_rows, axis=1)
+                # det(M - x_i x_i^T + x_j x_j^T) / det(M)
+                ratio = (1 - d_i) * (1 + d_j) + cross ** 2
+                ratio[~available] = -np.inf
+                best = np.argmax(ratio)
+                if ratio[best] > 1 + 1e-6:
+                    information += np.outer(pool_rows[best], pool_rows[best]) - np.outer(row, row)
+                    available[chosen[i]] = True
+                    available[best] = False
+                    chosen[i] = best
+                    improved = True
+            if not improved:
+                break
+
+        return pool[chosen]
+
+
+DESIGNS = {
+    'lhs': LatinHypercube,
+    'd-optimal': DOptimalDesign
+}
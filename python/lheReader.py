@@ -1,52 +1,324 @@
+from __future__ import print_function
+import gzip
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
 import xml.etree.ElementTree as ET
 
+import numpy as np
+
+from NPFitProduction.NPFitProduction.utils import NpzArchive, ParamCard
+
+# patterns for scanning the raw text of the events, see `lheReader.getWeightArray`
+EVENT_END = b'</event>'
+EVENT_START = re.compile(br'<event[\s>]')
+INIT_END = b'</init>'
+ORIGINAL_WEIGHT = re.compile(br'<event(?:\s[^>]*)?>\s*\S+\s+\S+\s+(\S+)')
+WEIGHT_VALUE = re.compile(br'<wgt[^>]*>([^<]*)</wgt>')
+WEIGHT_ID = re.compile(br'<wgt\s+id\s*=\s*[\'"]([^\'"]*)[\'"]')
+
 class lheReader(object):
+    """Streaming reader for (reweighted) LHE files
+
+    Events are parsed incrementally and cleared once they have been processed,
+    so memory use does not grow with the number of events in the file. Files
+    ending in .gz are decompressed on the fly.
+
+    With `cache` set, the weights of all events and the weight map are converted
+    once to a binary cache file which is reused for as long as the LHE file is
+    unchanged, see `getWeightCache`. `cache` can be True (to keep the cache next
+    to the LHE file), a directory to keep it in, or the path of the cache file.
+    """
     ORIGINAL = 'original'
 
-    def __init__(self,fn=None):
-        self.tree = None
-        self.root = None
-        self.events = []
+    def __init__(self,fn=None,cache=False):
+        self.fn = fn
+        self.cache = cache
+        self.cached = None      # The weight cache, once loaded
+        self._header = None
+        self._offsets = None    # The byte offset of each event, see `eventOffsets`
         self.lhacode_map = {}   # Maps the integer lhacode to the corresponding newcoup string name
         self.skip = False       # Flags the sample as having no re-weighted points
 
-        if fn is not None:
-            self.tree = ET.parse(fn)
-            self.root = self.tree.getroot()
-            self.events = self.root.findall('./event')
+    @property
+    def header(self):
+        """The header element of the file, which is parsed on first use
+        """
+        if self._header is None and self.fn is not None:
+            self._header = self.readHeader()
+        return self._header
+
+    @property
+    def events(self):
+        """The events of the file as a sequence, which parses each event when it is accessed
+        """
+        return EventSequence(self)
+
+    def openFile(self):
+        if self.fn.endswith('.gz'):
+            return gzip.open(self.fn, 'rb')
+        return open(self.fn, 'rb')
+
+    def readHeader(self):
+        """Parse only the header of the file, stopping before the first event
+        """
+        with self.openFile() as f:
+            for _, element in ET.iterparse(f):
+                if element.tag == 'header':
+                    return element
+                if element.tag in ('init', 'event'):
+                    break
+        return None
+
+    def iterEvents(self):
+        """Yield the events one at a time
+
+        Each event is cleared when the next one is requested, so the elements
+        must not be kept around.
+        """
+        if self.fn is None:
+            return
+        with self.openFile() as f:
+            context = ET.iterparse(f, events=('start', 'end'))
+            _, root = next(context)
+            for action, element in context:
+                if action == 'end' and element.tag == 'event':
+                    yield element
+                    element.clear()
+                    # drop the references the root keeps to processed events
+                    root.clear()
+
+    def getWeightArray(self,ids=None,blocksize=2**26,workers=1):
+        """Get the weights of all events as arrays
+
+        The weights are taken from the weight cache if it is enabled, and scanned
+        from the file otherwise (see `scanWeights`). The parameters and return
+        values are the same as for `scanWeights`.
+        """
+        if not self.cache:
+            return self.scanWeights(ids, blocksize, workers)
+
+        cached = self.getWeightCache(blocksize, workers)
+        if ids is None:
+            ids = cached['ids']
+        missing = [i for i in ids if i not in cached['ids']]
+        if len(missing) > 0:
+            raise RuntimeError('weights {} not found in {}'.format(', '.join(missing), self.fn))
+        columns = [cached['ids'].index(i) for i in ids]
+
+        return ids, cached['original'], cached['weights'][:, columns]
+
+    def cacheFiles(self):
+        """Return the possible locations of the weight cache, in order of preference
+
+        The last location is in the temporary directory, for LHE files on read-only storage.
+        """
+        if self.cache is True or os.path.isdir(self.cache):
+            directory = os.path.dirname(os.path.abspath(self.fn)) if self.cache is True else self.cache
+            preferred = os.path.join(directory, os.path.basename(self.fn) + '.weights.npz')
+        else:
+            preferred = self.cache
+        # different LHE files with the same name must not share the fallback
+        key = hashlib.sha1(os.path.abspath(self.fn).encode('utf8')).hexdigest()[:16]
+        fallback = os.path.join(tempfile.gettempdir(), '{}.{}.weights.npz'.format(os.path.basename(self.fn), key))
+
+        return [preferred, fallback]
+
+    def getWeightCache(self,blocksize=2**26,workers=1):
+        """Load the weight cache, (re)building it if it does not match the LHE file
+
+        The cache is an uncompressed .npz file with the original weights, the
+        weights (events x weight ids), and the weight map. It is considered valid
+        if the size of the LHE file is unchanged and either its modification time
+        or its fingerprint (see `file_fingerprint`) is unchanged.
+
+        The cache is written to the first location of `cacheFiles` which is writable.
+        If none is, the weights are only kept in memory.
+
+        Returns
+        ----------
+            dict
+                With keys 'ids', 'original', 'weights' and 'weight_map'. The
+                arrays are memory-mapped from the cache file.
+        """
+        if self.cached is not None:
+            return self.cached
+
+        stat = os.stat(self.fn)
+        fingerprint = file_fingerprint(self.fn)
+        for cache in self.cacheFiles():
+            if not os.path.isfile(cache):
+                continue
+            try:
+                archive = NpzArchive(cache, mmap_mode='r')
+                valid = (int(archive['source_size']) == stat.st_size and
+                         (float(archive['source_mtime']) == stat.st_mtime or
+                          str(archive['source_hash']) == fingerprint))
+            except Exception as e:
+                print('WARNING: ignoring unreadable weight cache {}: {}'.format(cache, e))
+                valid = False
+            if valid:
+                self.cached = self.readWeightCache(archive)
+                return self.cached
+
+        ids, original, weights = self.scanWeights(blocksize=blocksize, workers=workers)
+        map_ids = []
+        map_codes = []
+        map_values = []
+        for wgt_id, point in self.readWeightMap().items():
+            for lhacode, value in point.items():
+                map_ids.append(wgt_id)
+                map_codes.append(lhacode)
+                map_values.append(value)
+        arrays = dict(
+            source_size=stat.st_size,
+            source_mtime=stat.st_mtime,
+            source_hash=fingerprint,
+            ids=np.array(ids, dtype=str),
+            original=original,
+            weights=weights,
+            map_ids=np.array(map_ids, dtype=str),
+            map_codes=np.array(map_codes, dtype=int),
+            map_values=np.array(map_values, dtype=float)
+        )
+
+        for cache in self.cacheFiles():
+            # write to a unique temporary file first, so that an interrupted job does not leave
+            # a broken cache and concurrent readers do not overwrite each other
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache)),
+                                           prefix=os.path.basename(cache) + '.', suffix='.tmp.npz')
+            except (IOError, OSError):
+                continue
+            os.close(fd)
+            print('building weight cache {}'.format(cache))
+            try:
+                np.savez(tmp, **arrays)
+                os.rename(tmp, cache)
+            except (IOError, OSError) as e:
+                print('WARNING: could not write weight cache {}: {}'.format(cache, e))
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                continue
+            self.cached = self.readWeightCache(NpzArchive(cache, mmap_mode='r'))
+            return self.cached
+
+        print('WARNING: no writable location for the weight cache of {}'.format(self.fn))
+        self.cached = self.readWeightCache(arrays)
+
+        return self.cached
+
+    def readWeightCache(self,archive):
+        weight_map = {}
+        for wgt_id, lhacode, value in zip(archive['map_ids'], archive['map_codes'], archive['map_values']):
+            weight_map.setdefault(str(wgt_id), {})[int(lhacode)] = float(value)
+
+        return {
+            'ids': [str(i) for i in archive['ids']],
+            'original': archive['original'],
+            'weights': archive['weights'],
+            'weight_map': weight_map
+        }
+
+    def scanWeights(self,ids=None,blocksize=2**26,workers=1):
+        """Read the weights of all events into arrays
+
+        Instead of building elements for each event, the file is read in blocks
+        of `blocksize` bytes which end on an event boundary, and the weight values
+        of all events in a block are extracted with a single regular expression.
+        All events must contain the same weights in the same order, which is the
+        case for samples reweighted by Madgraph.
+
+        Parameters
+        ----------
+            ids : list of str
+                The weight ids to read. By default, all weights are read.
+            blocksize : int
+                Number of bytes to read at a time.
+            workers : int
+                Number of processes to read uncompressed files with, see `eventRanges`.
+
+        Returns
+        ----------
+            ids : list of str
+                The weight ids corresponding to the columns of `weights`.
+            original : np.ndarray
+                The original weight (XWGTUP) of each event.
+            weights : np.ndarray
+                The weights, with one row per event and one column per id.
+        """
+        event_ids = self.getEventWeightIds()
+        if ids is None:
+            ids = event_ids
+        missing = [i for i in ids if i not in event_ids]
+        if len(missing) > 0:
+            raise RuntimeError('weights {} not found in {}'.format(', '.join(missing), self.fn))
+
+        results = self.mapRanges(event_ids, ids, False, blocksize, workers)
+        results = [r for r in results if len(r[0]) > 0]
+        if len(results) == 0:
+            return ids, np.zeros(0), np.zeros((0, len(ids)))
+
+        return ids, np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def getEventWeightIds(self):
+        """Get the ids of the weights of the first event, in the order they appear in each event
+        """
+        with self.openFile() as f:
+            for data in read_event_blocks(f, 2**20):
+                first = data.find(b'<event')
+                if first >= 0:
+                    first_end = data.find(EVENT_END, first)
+                    return [x.decode('utf8') for x in WEIGHT_ID.findall(data, first, first_end)]
+        return []
+
+    def eventRanges(self,count):
+        """Split the events of the file into at most `count` byte ranges
+
+        Each range starts at the beginning of an event and ends at the beginning
+        of the next range (or the end of the file), so that the ranges can be
+        processed independently.
+        """
+        size = os.path.getsize(self.fn)
+        with open(self.fn, 'rb') as f:
+            starts = [find_event(f, 0, after=b'</init>')]
+            for i in range(1, count):
+                starts.append(find_event(f, max(starts[-1] + 1, starts[0] + (size - starts[0]) * i // count)))
+        starts = sorted(set(starts))
+
+        return list(zip(starts, starts[1:] + [size]))
+
+    def mapRanges(self,event_ids,ids,reduce,blocksize,workers):
+        """Scan the events in parallel byte ranges, see `scan_range`
+
+        Compressed files cannot be split, and are always scanned in a single range.
+        """
+        if workers <= 1 or self.fn.endswith('.gz'):
+            return [scan_range((self.fn, None, None, event_ids, ids, reduce, blocksize))]
+
+        tasks = [(self.fn, start, stop, event_ids, ids, reduce, blocksize)
+                 for start, stop in self.eventRanges(workers)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(scan_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
 
     def parseModelFile(self,np_param_path):
         #NOTE: This possibly should be placed somewhere else, as it doesn't directly involve the lhe file
         """Maps the newcoup lhacode to its corresponding name
         Ex: self.lhacode_map = {11:'cA',22:'cuB',23:'cuW'}
         """
-        self.lhacode_map = {}
-        in_block = False
-        with open(np_param_path) as f:
-            for l in f.readlines():
-                l = l.strip()
-                if l.lower() == "block newcoup":
-                    # Entering newcoup block
-                    in_block = True
-                    continue
-                if in_block:
-                    if l == "":
-                        # Exiting newcoup block
-                        in_block = False
-                        break
-                    sp_l = l.split("#",1)   # Split the line into non-comment and comment sections
-                    base = sp_l[0].strip()
-                    tail = sp_l[1].strip() if len(sp_l) > 1 else None
-                    if len(base.split()) != 2:
-                        print "ERROR: Failed to parse model file!"
-                        return
-                    lhacode = int(base.split()[0])
-                    self.lhacode_map[lhacode] = tail
+        newcoup = ParamCard.load(np_param_path).block('newcoup')
+        self.lhacode_map = dict((lhacode, entry.label) for lhacode, entry in newcoup.items())
 
     def getCouplingName(self,lhacode):
         """Attempts to map the specified lhacode to a newcoup name
         """
-        if self.lhacode_map.has_key(lhacode):
+        if lhacode in self.lhacode_map:
             return self.lhacode_map[lhacode]
         else:
             return lhacode
@@ -62,37 +334,27 @@ class lheReader(object):
             24: 0.2
         }
         """
+        if self.cache:
+            return self.getWeightCache()['weight_map']
+        return self.readWeightMap()
+
+    def readWeightMap(self):
+        """Read the weight map (see `getWeightMap`) from the header of the file
+        """
         weight_map = {}
-        if self.tree is None or self.root is None:
+        if self.header is None:
             return weight_map
 
         # Map the initial point first
-        slha = self.root.find('./header/slha')
+        slha = self.header.find('slha')
         if slha is None:
-            print "WARNING: No slha tag found!"
+            print("WARNING: No slha tag found!")
             return weight_map
-        weight_map[self.ORIGINAL] = {}
-        in_block = False
-        for l in slha.text.strip().split('\n'):
-            l = l.strip()
-            if l.lower() == "block newcoup":
-                # Entering newcoup block
-                in_block = True
-                continue
-            if in_block:
-                if l == "":
-                    # Exiting newcoup block
-                    in_block = False
-                    break
-                sp_l = l.split("#",1)   # Split the line into non-comment and comment sections
-                base = sp_l[0].strip()
-                tail = sp_l[1].strip() if len(sp_l) > 1 else None
-                if len(base) > 0:
-                    coeff_id,val = base.split()
-                    weight_map[self.ORIGINAL][int(coeff_id)] = float(val)
+        newcoup = ParamCard(slha.text).block('newcoup')
+        weight_map[self.ORIGINAL] = dict((lhacode, entry.value) for lhacode, entry in newcoup.items())
 
         # Map the re-weighted points next
-        for weight in self.root.iter('weight'):
+        for weight in self.header.iter('weight'):
             wgt_id = weight.attrib.get('id')
             weight_map[wgt_id] = {}
             for l in weight.text.split('\n')[:-1]:
@@ -100,15 +362,54 @@ class lheReader(object):
                 weight_map[wgt_id][int(coeff_id)] = float(val)
         return weight_map
 
+    def eventOffsets(self):
+        """Return the byte offset of the start of each event
+
+        The offsets are found with a single pass over the file, and kept for
+        later calls. For compressed files, they are offsets in the decompressed stream.
+        """
+        if self._offsets is None:
+            offsets = []
+            position = 0
+            if self.fn is not None:
+                with self.openFile() as f:
+                    for data in read_event_blocks(f, 2**24):
+                        # the header and init block always end up in the first block
+                        start = data.find(INIT_END) if position == 0 else 0
+                        for match in EVENT_START.finditer(data, max(start, 0)):
+                            offsets.append(position + match.start())
+                        position += len(data)
+            self._offsets = np.array(offsets, dtype=np.int64)
+        return self._offsets
+
+    def readEventText(self,f,offset):
+        """Return the text of the event starting at `offset` of an open file
+        """
+        f.seek(offset)
+        data = b''
+        while True:
+            block = f.read(2**16)
+            data += block
+            end = data.find(EVENT_END)
+            if end >= 0:
+                return data[:end + len(EVENT_END)]
+            if not block:
+                return data
+
     def getEvent(self,i):
         """Get a specific event
+
+        Events are found with the offsets of `eventOffsets`, so only the requested event
+        is parsed. Seeking in compressed files decompresses everything up to the event,
+        so use `iterEvents` or `events` to loop over their events.
         """
-        if self.tree is None:
-            return None
-        if i >= len(self.events):
-            print "ERROR: Event index out of range!"
+        offsets = self.eventOffsets()
+        if i < 0 or i >= len(offsets):
+            if self.fn is not None:
+                print("ERROR: Event index out of range!")
             return None
-        return self.events[i]
+        with self.openFile() as f:
+            return ET.fromstring(self.readEventText(f, offsets[i]))
 
     def getEventWeights(self,event_num):
         """Get original weight and re-weighted values for a specific event
@@ -118,17 +419,42 @@ class lheReader(object):
           'mg_reweight_2': 0.03,
         }
         """
+        if self.cache:
+            cached = self.getWeightCache()
+            if event_num >= len(cached['original']):
+                print("ERROR: Event index out of range!")
+                return None
+            event_weights = dict(zip(cached['ids'], cached['weights'][event_num]))
+            event_weights[self.ORIGINAL] = cached['original'][event_num]
+            return event_weights
+
         event = self.getEvent(event_num)
         if event is None:
             return None
-        
+        return self.eventWeights(event)
+
+    def getOriginalEventWeight(self,event_num):
+        """Get the original event weight (XWGTUP) for a specific event
+        """
+        if self.cache:
+            event_weights = self.getEventWeights(event_num)
+            return None if event_weights is None else event_weights[self.ORIGINAL]
+
+        event = self.getEvent(event_num)
+        if event is None:
+            return None
+        return self.originalEventWeight(event)
+
+    def eventWeights(self,event):
+        """Get original weight and re-weighted values for an event element, see `getEventWeights`
+        """
         event_weights = {}
-        event_weights[self.ORIGINAL] = self.getOriginalEventWeight(event_num)
+        event_weights[self.ORIGINAL] = self.originalEventWeight(event)
 
         if self.skip:
             return event_weights
         elif event.find('rwgt') is None:
-            print "WARNING: LHE file doesn't have re-weighted points!"
+            print("WARNING: LHE file doesn't have re-weighted points!")
             self.skip = True
             return event_weights
 
@@ -137,66 +463,341 @@ class lheReader(object):
             event_weights[wgt_id] = float(wgt.text.strip())
         return event_weights
 
-    def getOriginalEventWeight(self,event_num):
-        """Get the original event weight (XWGTUP) for a specific event
+    def originalEventWeight(self,event):
+        """Get the original event weight (XWGTUP) for an event element
         """
-        event = self.getEvent(event_num)
-        if event is None:
-            return None
         line = event.text.strip().split('\n')[0]
         wgt = float(line.split()[2])
         return wgt
 
-    def getWeightBounds(self):
+    def getWeightStatistics(self,ids=None,workers=1):
+        """Accumulate the statistics of the original and other weights in a single pass
+
+        Parameters
+        ----------
+            ids : list of str
+                The weight ids to include. By default, all weights are included.
+            workers : int
+                Number of processes to read uncompressed files with, see `eventRanges`.
+
+        Returns
+        ----------
+            WeightStatistics
+                The statistics, which can be merged with those of other files.
+        """
+        if self.cache:
+            ids, original, weights = self.getWeightArray(ids)
+            statistics = WeightStatistics(ids)
+            statistics.add(original, weights)
+            return statistics
+
+        event_ids = self.getEventWeightIds()
+        if ids is None:
+            ids = event_ids
+        missing = [i for i in ids if i not in event_ids]
+        if len(missing) > 0:
+            raise RuntimeError('weights {} not found in {}'.format(', '.join(missing), self.fn))
+
+        statistics = WeightStatistics(ids)
+        for result in self.mapRanges(event_ids, ids, True, 2**26, workers):
+            statistics.merge(result)
+        return statistics
+
+    def getWeightBounds(self,workers=1):
         """Returns the largest and smallest weights in the entire sample, for all weightings
+
+        With `workers` > 1, uncompressed files are split into byte ranges which are
+        processed in parallel.
         """
-        init_wgt = self.getOriginalEventWeight(0)
-        if init_wgt is None:
+        statistics = self.getWeightStatistics(workers=workers)
+        if statistics.events == 0:
             return None,None
-        lo = init_wgt
-        hi = init_wgt
-        for idx in range(len(self.events)):
-            event_wgts = self.getEventWeights(event_num=idx)
-            for wgt_id,wgt_val in event_wgts.iteritems():
-                if wgt_val < lo:
-                    lo = wgt_val
-                if wgt_val > hi:
-                    hi = wgt_val
-        return lo,hi
-
-    def getCrossSections(self):
-        #TODO: Include calculated error
+        return statistics.minima.min(),statistics.maxima.max()
+
+    def getCrossSections(self,workers=1):
         """Re-calculates the cross sections by summing over event weights
+
+        The errors are available from `getWeightStatistics`. With `workers` > 1,
+        uncompressed files are split into byte ranges which are processed in parallel.
         """
-        xsecs = {key: 0.0 for key in self.getWeightMap().keys()}
-        for idx in range(len(self.events)):
-            event_wgts = self.getEventWeights(event_num=idx)
-            for wgt_id,wgt_val in event_wgts.iteritems():
-                xsecs[wgt_id] += wgt_val
+        xsecs = dict((key, 0.0) for key in self.getWeightMap().keys())
+        xsecs.update(zip(*self.getWeightStatistics(workers=workers).cross_sections()))
         return xsecs
 
+class EventSequence(object):
+    """The events of an LHE file, see `lheReader.events`
+
+    Unlike `lheReader.iterEvents`, each event is a separate element which is not
+    cleared, so events can be kept around.
+    """
+
+    def __init__(self,reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader.eventOffsets())
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('event index out of range')
+        return self.reader.getEvent(i)
+
+    def __iter__(self):
+        if self.reader.fn is None:
+            return
+        with self.reader.openFile() as f:
+            first = True
+            for data in read_event_blocks(f, 2**24):
+                start = max(data.find(INIT_END), 0) if first else 0
+                first = False
+                for match in EVENT_START.finditer(data, start):
+                    end = data.find(EVENT_END, match.start())
+                    yield ET.fromstring(data[match.start():end + len(EVENT_END)])
+
+class WeightStatistics(object):
+    """Single-pass statistics of the original and reweighted event weights
+
+    For the original weight and each weight id, the sum, sum of squares, sum of
+    products with the original weight, minimum and maximum are accumulated.
+    Statistics of different parts of a file, or of different files, can be merged.
+    """
+
+    def __init__(self,ids):
+        self.ids = [lheReader.ORIGINAL] + list(ids)
+        self.events = 0
+        self.sums = np.zeros(len(self.ids))
+        self.squares = np.zeros(len(self.ids))
+        self.products = np.zeros(len(self.ids))
+        self.minima = np.full(len(self.ids), np.inf)
+        self.maxima = np.full(len(self.ids), -np.inf)
+
+    def add(self,original,weights):
+        """Add events
+
+        Parameters
+        ----------
+            original : np.ndarray
+                The original weight of each event.
+            weights : np.ndarray
+                The weights, with one row per event and one column per id.
+        """
+        if len(original) == 0:
+            return
+        values = np.column_stack([original, weights])
+        self.events += len(values)
+        self.sums += values.sum(axis=0)
+        self.squares += (values ** 2).sum(axis=0)
+        self.products += np.dot(original, values)
+        self.minima = np.minimum(self.minima, values.min(axis=0))
+        self.maxima = np.maximum(self.maxima, values.max(axis=0))
+
+    def merge(self,other):
+        """Add the events of another set of statistics with the same weight ids
+        """
+        if other.ids != self.ids:
+            raise RuntimeError('cannot merge statistics of different weights')
+        self.events += other.events
+        self.sums += other.sums
+        self.squares += other.squares
+        self.products += other.products
+        self.minima = np.minimum(self.minima, other.minima)
+        self.maxima = np.maximum(self.maxima, other.maxima)
+        return self
+
+    def cross_sections(self):
+        """Return the weight ids and the cross section (sum of weights) for each
+        """
+        return self.ids, self.sums
+
+    def errors(self):
+        """Return the statistical error on the sum of weights of each weight id
+        """
+        if self.events == 0:
+            return np.zeros(len(self.ids))
+        return np.sqrt(np.maximum(self.squares - self.sums ** 2 / self.events, 0.))
+
+    def effective_sizes(self):
+        """Return the effective sample size, (sum w)^2 / sum w^2, of each weight id
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.squares > 0, self.sums ** 2 / self.squares, 0.)
+
+    def ratios(self):
+        """Return the ratio of the sum of each weight to the sum of the original weights,
+        and its statistical error
+
+        The error is that of a ratio estimator, sqrt(sum (w - r w_0)^2) / |sum w_0|,
+        which accounts for the correlation between the reweighted and original weights.
+        """
+        ratios = self.sums / self.sums[0]
+        errors = np.sqrt(np.maximum(self.squares - 2 * ratios * self.products + ratios ** 2 * self.squares[0], 0.))
+        return ratios, errors / np.abs(self.sums[0])
+
+def read_event_blocks(f,blocksize,length=None):
+    """Yield blocks of text from `f` which end on an event boundary
+
+    Parameters
+    ----------
+        f : file
+            The file to read from, starting at the current position.
+        blocksize : int
+            Number of bytes to read at a time.
+        length : int
+            Number of bytes to read in total. By default, read until the end of the file.
+    """
+    tail = b''
+    while True:
+        size = blocksize if length is None else min(blocksize, length)
+        block = f.read(size) if size > 0 else b''
+        if length is not None:
+            length -= len(block)
+        data = tail + block
+        end = data.rfind(EVENT_END)
+        if end < 0 and block:
+            tail = data
+            continue
+        end = len(data) if end < 0 else end + len(EVENT_END)
+        data, tail = data[:end], data[end:]
+        yield data
+        if not block:
+            break
+
+def parse_event_block(data,nweights):
+    """Extract the original weights and the other weights of all events in a block of text
+
+    Returns
+    ----------
+        original : np.ndarray
+            The original weight (XWGTUP) of each event.
+        weights : np.ndarray
+            The weights, with one row per event and `nweights` columns.
+    """
+    original = np.fromstring(b' '.join(ORIGINAL_WEIGHT.findall(data)), sep=' ')
+    values = np.fromstring(b' '.join(WEIGHT_VALUE.findall(data)), sep=' ')
+    if len(values) != len(original) * nweights:
+        raise RuntimeError('events do not all have the same weights')
+
+    return original, values.reshape(len(original), nweights)
+
+def find_event(f,offset,after=None):
+    """Return the offset of the first event starting at or after `offset`
+
+    If `after` is given, only events after its first occurrence are considered.
+    Returns the size of the file if there is none.
+    """
+    blocksize = 2**20
+    f.seek(offset)
+    tokens = [t for t in (after, b'<event') if t is not None]
+    overlap = b''
+    position = offset
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            return position
+        data = overlap + block
+        start = 0
+        while len(tokens) > 0:
+            found = data.find(tokens[0], start)
+            if found < 0:
+                break
+            start = found + len(tokens[0])
+            tokens.pop(0)
+        if len(tokens) == 0:
+            return position - len(overlap) + found
+        keep = len(tokens[0]) - 1
+        overlap = data[max(start, len(data) - keep):]
+        position += len(block)
+
+def scan_range(args):
+    """Extract the weights of the events in a byte range of an LHE file
+
+    Parameters
+    ----------
+        args : tuple
+            (fn, start, stop, event_ids, ids, reduce, blocksize); a single argument so
+            it can be mapped over by a process pool. If `start` is None, the whole file
+            is read. `event_ids` are the ids of the weights of each event, of which only
+            `ids` are kept.
+
+    Returns
+    ----------
+        tuple or WeightStatistics
+            (original, weights) if `reduce` is False, and otherwise the statistics
+            of the weights.
+    """
+    fn, start, stop, event_ids, ids, reduce, blocksize = args
+    columns = [event_ids.index(i) for i in ids]
+    if start is None:
+        f = gzip.open(fn, 'rb') if fn.endswith('.gz') else open(fn, 'rb')
+        length = None
+    else:
+        f = open(fn, 'rb')
+        f.seek(start)
+        length = stop - start
+
+    originals = []
+    weights = []
+    statistics = WeightStatistics(ids)
+    try:
+        for data in read_event_blocks(f, blocksize, length):
+            original, values = parse_event_block(data, len(event_ids))
+            if len(original) == 0:
+                continue
+            if reduce:
+                statistics.add(original, values[:, columns])
+            else:
+                originals.append(original)
+                weights.append(values[:, columns])
+    except RuntimeError as e:
+        raise RuntimeError('{}: {}'.format(fn, e))
+    finally:
+        f.close()
+
+    if reduce:
+        return statistics
+    if len(originals) == 0:
+        return np.zeros(0), np.zeros((0, len(columns)))
+
+    return np.concatenate(originals), np.concatenate(weights)
+
+def file_fingerprint(fn,blocksize=2**20):
+    """Calculate the SHA-1 hash of the size, the first and the last `blocksize` bytes of a file
+
+    This detects changes to files which are only ever written whole or appended to (as
+    LHE files are), without reading all of a file which can be many GB.
+    """
+    digest = hashlib.sha1()
+    size = os.path.getsize(fn)
+    digest.update(str(size).encode('utf8'))
+    with open(fn, 'rb') as f:
+        digest.update(f.read(blocksize))
+        f.seek(max(size - blocksize, 0))
+        digest.update(f.read(blocksize))
+    return digest.hexdigest()
+
 if __name__ == "__main__":
     # Example usage
     sandbox       = "reweight_v4"
     lhe_path      = "%s/processtmp/Events/run_01/unweighted_events.lhe" % (sandbox)
     np_model_path = "%s/models/HEL_UFO/restrict_no_b_mass.dat" % (sandbox)
     
-    print "Parsing tree..."
+    print("Parsing header...")
     lhe_tree  = lheReader(lhe_path)
     coeff_pts = lhe_tree.getWeightMap()
-    n_events  = len(lhe_tree.events)
 
     lhe_tree.parseModelFile(np_model_path)
 
-    print "Getting bounds..."
-    low,high = lhe_tree.getWeightBounds()
-    print "Low Weight : %s" % (low)
-    print "High Weight: %s" % (high)
+    print("Getting weight statistics...")
+    stats = lhe_tree.getWeightStatistics()
+    print("Low Weight : %s" % (stats.minima.min()))
+    print("High Weight: %s" % (stats.maxima.max()))
 
-    print "Getting cross sections..."
-    xsecs = lhe_tree.getCrossSections()
-    for wgt_id in sorted(xsecs.keys()):
-        if coeff_pts.has_key(wgt_id):
-            print "%s: %s (%s)" % (wgt_id,xsecs[wgt_id],coeff_pts[wgt_id])
+    errs  = dict(zip(stats.ids,stats.errors()))
+    ess   = dict(zip(stats.ids,stats.effective_sizes()))
+    for wgt_id,xsec in zip(*stats.cross_sections()):
+        if wgt_id in coeff_pts:
+            print("%s: %s +- %s, ESS %.0f (%s)" % (wgt_id,xsec,errs[wgt_id],ess[wgt_id],coeff_pts[wgt_id]))
         else:
-            print "%s: %s" % (wgt_id,xsecs[wgt_id])
\ No newline at end of file
+            print("%s: %s +- %s, ESS %.0f" % (wgt_id,xsec,errs[wgt_id],ess[wgt_id]))
@@ -1,12 +1,15 @@
 from __future__ import print_function
+import abc
 import collections
 import itertools
 import numpy as np
 import os
 import re
 import shutil
+import struct
 import subprocess
 import tempfile
+import zipfile
 
 
 class TupleKeyDict(collections.MutableMapping):
@@ -42,6 +45,459 @@ class TupleKeyDict(collections.MutableMapping):
         return key
 
 
+class ColumnStore(object):
+    """Append-friendly columnar storage for the points of one (coefficients, process)
+
+    Points, cross sections and errors are kept in preallocated arrays whose
+    capacity doubles when full, so appending n rows one at a time costs O(n)
+    overall instead of the O(n^2) of repeatedly stacking arrays. Reading a
+    column returns a view of the filled rows; nothing is copied.
+    """
+
+    def __init__(self, dim, capacity=16):
+        self.size = 0
+        self._owned = True
+        self._points = np.empty((capacity, dim))
+        self._cross_sections = np.empty(capacity)
+        self._errs = np.empty(capacity)
+
+    @classmethod
+    def from_arrays(cls, points, cross_sections, errs):
+        """Wrap existing arrays without copying them
+
+        The arrays are only copied once more rows are appended, so read-only
+        (for example, memory-mapped) arrays can be wrapped safely.
+        """
+        store = cls.__new__(cls)
+        store.size = len(points)
+        store._owned = False
+        store._points = points
+        store._cross_sections = cross_sections
+        store._errs = errs
+        return store
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self._points)
+
+    @property
+    def points(self):
+        return self._points[:self.size]
+
+    @property
+    def cross_sections(self):
+        return self._cross_sections[:self.size]
+
+    @property
+    def errs(self):
+        return self._errs[:self.size]
+
+    def reserve(self, capacity):
+        """Make room for at least `capacity` rows"""
+        if self._owned and capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity, 16)
+        for name in ['_points', '_cross_sections', '_errs']:
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=np.result_type(old.dtype, np.float64))
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self._owned = True
+
+    def append(self, points, cross_sections, errs):
+        rows = len(points)
+        if not self._owned or self.size + rows > self.capacity:
+            self.reserve(self.size + rows)
+        self._points[self.size:self.size + rows] = points
+        self._cross_sections[self.size:self.size + rows] = cross_sections
+        self._errs[self.size:self.size + rows] = errs
+        self.size += rows
+
+
+class NpzArchive(object):
+    """Read arrays from an .npz file one member at a time
+
+    Unlike `np.load`, members of uncompressed archives (as written by `np.savez`)
+    can be memory-mapped: with `mmap_mode` set to 'r' or 'c', reading a member
+    only parses its header, and data is paged in from disk as it is used.
+    Object arrays are never unpickled.
+    """
+
+    def __init__(self, fn, mmap_mode=None):
+        if mmap_mode not in (None, 'r', 'c'):
+            raise ValueError('unsupported mmap_mode {}'.format(mmap_mode))
+        self.fn = fn
+        self.mmap_mode = mmap_mode
+        with zipfile.ZipFile(fn) as archive:
+            self.members = dict((info.filename[:-4], info) for info in archive.infolist()
+                                if info.filename.endswith('.npy'))
+
+    @property
+    def files(self):
+        return list(self.members.keys())
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __getitem__(self, name):
+        info = self.members[name]
+        if self.mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.fn) as archive:
+                f = archive.open(info)
+                try:
+                    return np.lib.format.read_array(f, allow_pickle=False)
+                finally:
+                    f.close()
+
+        with open(self.fn, 'rb') as f:
+            # the data of a stored member follows its local file header, see
+            # https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT section 4.3.7
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if dtype.hasobject:
+            raise ValueError('{} in {} is an object array'.format(name, self.fn))
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype)
+
+        return np.memmap(
+            self.fn,
+            dtype=dtype,
+            mode=self.mmap_mode,
+            offset=offset,
+            shape=shape,
+            order='F' if fortran_order else 'C'
+        )
+
+
+def format_value(value):
+    """Return the text of a parameter value, with all the digits needed to read it back exactly
+    """
+    return repr(float(value))
+
+
+class ParamCard(object):
+    """Parsed SLHA parameter card
+
+    Entries are looked up by block and index, or by name (the first word of the
+    comment after the value, for example 'cuB'). Blocks are case-insensitive, names are not.
+    The position of each value in the text is kept, so the card can be written
+    with new values without matching the lines again. Use `ParamCard.load` to
+    share the parsed card between callers.
+    """
+
+    Entry = collections.namedtuple('Entry', ['block', 'index', 'value', 'label', 'line', 'start', 'end'])
+
+    block_pattern = re.compile(r'^\s*block\s+(\S+)', re.IGNORECASE)
+    decay_pattern = re.compile(r'^(\s*decay\s+(\d+)\s+)([^\s#]+)(.*)$', re.IGNORECASE | re.DOTALL)
+    entry_pattern = re.compile(r'^(\s*((?:[+-]?\d+\s+)+))([^\s#]+)(.*)$', re.DOTALL)
+
+    cache = {}
+
+    def __init__(self, text):
+        self.lines = text.splitlines(True) if hasattr(text, 'splitlines') else list(text)
+        self.blocks = collections.OrderedDict()
+        self.names = {}
+
+        block = None
+        for number, line in enumerate(self.lines):
+            match = self.block_pattern.match(line)
+            if match:
+                block = match.group(1)
+                continue
+            match = self.decay_pattern.match(line)
+            if match:
+                # the decay table which may follow is not parsed
+                self.add('DECAY', int(match.group(2)), match, number)
+                block = None
+                continue
+            match = self.entry_pattern.match(line)
+            if match and block is not None:
+                index = tuple(int(i) for i in match.group(2).split())
+                self.add(block, index[0] if len(index) == 1 else index, match, number)
+
+    @classmethod
+    def load(cls, fn):
+        """Return the parsed card in `fn`, which is only parsed again if the file changed
+        """
+        fn = os.path.abspath(fn)
+        stat = os.stat(fn)
+        key = (stat.st_mtime, stat.st_size)
+        if fn not in cls.cache or cls.cache[fn][0] != key:
+            with open(fn) as f:
+                cls.cache[fn] = (key, cls(f.read()))
+
+        return cls.cache[fn][1]
+
+    def add(self, block, index, match, number):
+        try:
+            value = float(match.group(3))
+        except ValueError:
+            return
+        comment = match.group(4).strip()
+        label = comment[1:].strip() if comment.startswith('#') else None
+        entry = self.Entry(block, index, value, label, number, match.start(3), match.end(3))
+
+        self.blocks.setdefault(block.lower(), collections.OrderedDict())[index] = entry
+        if label:
+            self.names.setdefault(label.split()[0], entry)
+
+    def block(self, name):
+        """Return the entries of a block, by index
+        """
+        return self.blocks.get(name.lower(), collections.OrderedDict())
+
+    def entry(self, block, index):
+        return self.block(block)[index]
+
+    def find(self, name):
+        """Return the entry with the given name, or None
+        """
+        return self.names.get(name)
+
+    def ids(self, names):
+        """Return the indices of named entries, and the block of the last one found
+
+        Entries which are not found are skipped.
+        """
+        ids = {}
+        block = None
+        for name in names:
+            entry = self.find(name)
+            if entry is not None:
+                ids[name] = entry.index
+                block = entry.block
+
+        return ids, block
+
+    def template(self, names):
+        """Compile the card into a template with a slot for the value of each named entry
+
+        Parameters
+        ----------
+            names : list of str
+                The names of the entries to make slots for, in the order in
+                which the values will be passed to `CardTemplate.render`.
+        """
+        entries = []
+        for name in names:
+            entry = self.find(name)
+            if entry is None:
+                raise RuntimeError('parameter {} not found in card'.format(name))
+            entries.append(entry)
+
+        offsets = np.cumsum([0] + [len(line) for line in self.lines])
+        text = ''.join(self.lines)
+        order = sorted(range(len(entries)), key=lambda i: (entries[i].line, entries[i].start))
+        pieces = []
+        position = 0
+        for i in order:
+            pieces.append(text[position:offsets[entries[i].line] + entries[i].start])
+            position = offsets[entries[i].line] + entries[i].end
+        pieces.append(text[position:])
+
+        return CardTemplate(pieces, order)
+
+    def format(self, values):
+        """Return the text of the card with new values
+
+        Parameters
+        ----------
+            values : dict
+                New values, by name.
+        """
+        lines = list(self.lines)
+        for name, value in values.items():
+            entry = self.find(name)
+            if entry is None:
+                raise RuntimeError('parameter {} not found in card'.format(name))
+            line = lines[entry.line]
+            lines[entry.line] = line[:entry.start] + format_value(value) + line[entry.end:]
+
+        return ''.join(lines)
+
+    def write(self, fn, values):
+        """Write the card to `fn` with new values, see `format`
+        """
+        with open(fn, 'w') as f:
+            f.write(self.format(values))
+        self.cache.pop(os.path.abspath(fn), None)
+
+
+class CardTemplate(object):
+    """Text with numeric slots which is compiled once and rendered for many points
+
+    Rendering a point only formats the values and joins them with the static
+    text, no matter how large the text is.
+    """
+
+    def __init__(self, pieces, order=None):
+        """
+        Parameters
+        ----------
+            pieces : list of str
+                The static text before, between, and after the slots.
+            order : list of int
+                The position in the point of the value for each slot. By default,
+                the slots are filled in the order of the point.
+        """
+        self.pieces = list(pieces)
+        self.order = list(range(len(pieces) - 1)) if order is None else list(order)
+        self.slots = list(zip(self.order, self.pieces[1:]))
+
+    def render(self, point):
+        text = [self.pieces[0]]
+        for i, piece in self.slots:
+            text.append(format_value(point[i]))
+            text.append(piece)
+        return ''.join(text)
+
+    def render_many(self, points):
+        """Return the concatenated text for all points
+        """
+        return ''.join(self.render(point) for point in np.asarray(points, dtype=float).tolist())
+
+    def write(self, fn, point):
+        with open(fn, 'w') as f:
+            f.write(self.render(point))
+
+
+class IndexedPoints(abc.ABCMeta('ABC', (object,), {})):
+    """Base class for sets of points which are calculated from their index instead of stored
+
+    They can be indexed like an array of points with an int, a slice, or an array
+    of ints; only the requested points are calculated. Subclasses set `size` (the
+    number of points) and `dim` (the number of coefficients), and implement `rows`.
+    """
+
+    size = 0
+    dim = 0
+
+    @property
+    def shape(self):
+        """The shape of the array of all points, (points, coefficients)
+        """
+        return (self.size, self.dim)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.points(np.arange(*index.indices(self.size)))
+        if np.ndim(index) == 0:
+            return self.points(np.array([index]))[0]
+        return self.points(np.array(index))
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def __array__(self, dtype=None, copy=None):
+        res = self[:]
+        return res if dtype is None else res.astype(dtype)
+
+    def points(self, indices):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + self.size, indices)
+        if np.any((indices < 0) | (indices >= self.size)):
+            raise IndexError('point index out of range')
+        return self.rows(indices)
+
+    @abc.abstractmethod
+    def rows(self, indices):
+        """Return the points at `indices`, which are all in range
+        """
+
+
+class Grid(IndexedPoints):
+    """The cartesian product of values along each axis, see `cartesian_product`
+
+    Points are ordered as in `cartesian_product` (the last axis varies fastest), and
+    point i is calculated by dividing i by the number of values along each axis, so
+    the product is never stored.
+    """
+
+    def __init__(self, axes, sm=False):
+        """
+        Parameters
+        ----------
+            axes : list of arrays
+                The values along each axis.
+            sm : bool
+                If True, the SM point (zero along every axis) is prepended at index 0.
+        """
+        self.axes = [np.asarray(axis, dtype=float).reshape(-1) for axis in axes]
+        self.axis_lengths = tuple(len(axis) for axis in self.axes)
+        self.dim = len(self.axes)
+        self.sm = bool(sm)
+        self.size = int(self.sm)
+        product = 1
+        for length in self.axis_lengths:
+            product *= length
+        self.size += product
+
+    def rows(self, indices):
+        res = np.zeros((len(indices), self.dim))
+        if self.sm:
+            rows = np.nonzero(indices > 0)[0]
+            remainder = indices[rows] - 1
+        else:
+            rows = np.arange(len(indices))
+            remainder = indices
+        for column in reversed(range(len(self.axes))):
+            remainder, position = np.divmod(remainder, self.axis_lengths[column])
+            res[rows, column] = self.axes[column][position]
+
+        return res
+
+    def subgrid(self, column, values):
+        """Return the grid with the values along axis `column` replaced (without the SM point)
+        """
+        axes = list(self.axes)
+        axes[column] = values
+
+        return Grid(axes)
+
+    def perimeter(self):
+        """Return the faces of the grid, each axis fixed to its last and then its first value
+        """
+        faces = []
+        for column, axis in enumerate(self.axes):
+            faces += [self.subgrid(column, axis[-1:]), self.subgrid(column, axis[:1])]
+
+        return GridChain(faces)
+
+
+class GridChain(IndexedPoints):
+    """Several grids indexed one after another, like `np.vstack` of them
+    """
+
+    def __init__(self, grids):
+        self.grids = list(grids)
+        self.offsets = np.cumsum([0] + [len(grid) for grid in self.grids])
+        self.size = int(self.offsets[-1])
+        self.dim = self.grids[0].dim if len(self.grids) > 0 else 0
+
+    def rows(self, indices):
+        res = np.zeros((len(indices), self.dim))
+        owners = np.searchsorted(self.offsets, indices, side='right') - 1
+        for owner in np.unique(owners):
+            rows = owners == owner
+            res[rows] = self.grids[owner].points(indices[rows] - self.offsets[owner])
+
+        return res
+
+
 class TempDir(object):
     """ Class for temporary directories
 
@@ -93,6 +549,191 @@ def cartesian_product(*arrays):
 def sorted_combos(items, dimension):
     return sorted([tuple(sorted(items)) for items in itertools.combinations(items, dimension)])
 
+def count_combos(n, dimension):
+    """Return the number of combinations of `dimension` out of `n` items
+    """
+    if dimension < 0 or dimension > n:
+        return 0
+    res = 1
+    for i in range(dimension):
+        res = res * (n - i) // (i + 1)
+    return res
+
+def nth_combo(items, dimension, index):
+    """Return `sorted_combos(items, dimension)[index]` without generating the others
+    """
+    items = sorted(items)
+    res = []
+    start = 0
+    for slot in range(dimension):
+        for i in range(start, len(items)):
+            # number of combos with items[i] in this slot
+            count = count_combos(len(items) - i - 1, dimension - slot - 1)
+            if index < count:
+                res.append(items[i])
+                start = i + 1
+                break
+            index -= count
+    return tuple(res)
+
+def mix(*keys):
+    """Return a 64-bit hash of integer keys (splitmix64), for seeding without a generator
+    """
+    x = 0
+    for key in keys:
+        x = (x + int(key) + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        x = x ^ (x >> 31)
+    return x
+
+def permute(index, n, *keys):
+    """Return the position of `index` in a pseudo-random permutation of range(n) seeded by `keys`
+
+    The permutation is a four-round Feistel network on the smallest even number of
+    bits covering n, and positions outside range(n) are mapped again until they fall
+    inside it (cycle walking). The position of any index can be calculated by itself,
+    which is all that is needed to shuffle a sequence which is too large to store.
+    """
+    if index < 0 or index >= n:
+        raise IndexError('permutation index out of range')
+    half = max(1, (int(n - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    x = index
+    while True:
+        left, right = x >> half, x & mask
+        for step in range(4):
+            left, right = right, left ^ (mix(step, right, *keys) & mask)
+        x = (left << half) | right
+        if x < n:
+            return x
+
+def parse_indices(values):
+    """Return the point indices of a task spec, see `TaskSpecs`
+
+    Parameters
+    ----------
+        values : list of str
+            Indices and ranges of indices start:stop (excluding stop), for example
+            ['0:5', '12'] for [0, 1, 2, 3, 4, 12].
+    """
+    res = []
+    for value in values:
+        if ':' in value:
+            start, stop = value.split(':')
+            res += list(range(int(start), int(stop)))
+        else:
+            res.append(int(value))
+    return res
+
+
+class TaskSpecs(object):
+    """The task arguments for calculating the points of every coefficient group and process in chunks
+
+    Each task is the string '{coefficient group} {process}.dat {start}:{stop}', which the
+    scan scripts decode with `parse_indices`. The points of each group and process (a pair)
+    are split into chunks of `size`. The chunks containing the SM point (index 0) come
+    first, followed by at most `maxchunks` other chunks per pair. The pairs are taken in a
+    seeded random order, and the chunks of each pair in a seeded random order of their own.
+
+    Iterating generates the tasks one pair at a time, so they are never all stored. Any
+    task can also be looked up by its position, which only needs the order of its pair.
+    """
+
+    # pairs with more chunks than this are permuted with `permute` instead of numpy
+    permutation_limit = 2 ** 20
+
+    def __init__(self, size, totalpoints, processes, coefficients, dim=1, maxchunks=None, seed=0):
+        """
+        Parameters
+        ----------
+            size : int
+                The number of points per task.
+            totalpoints : int
+                The number of points per group and process, including the SM point.
+            processes : list of str
+            coefficients : list of str
+            dim : int
+                The number of coefficients per group.
+            maxchunks : int
+                The maximum number of tasks per group and process, in addition to the SM task.
+            seed : int
+        """
+        self.size = min(size, totalpoints)
+        self.totalpoints = totalpoints
+        self.processes = list(processes)
+        self.coefficients = sorted(coefficients)
+        self.dim = dim
+        self.seed = seed
+        self.groups = count_combos(len(self.coefficients), dim)
+        self.pairs = self.groups * len(self.processes)
+
+        chunks = -(-totalpoints // self.size)
+        self.other_chunks = chunks - 1
+        self.chunks_per_pair = self.other_chunks if maxchunks is None else min(maxchunks, self.other_chunks)
+        self.length = self.pairs * (1 + self.chunks_per_pair)
+        self.pair_order = np.random.RandomState(seed).permutation(self.pairs)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        groups = [','.join(group) for group in itertools.combinations(self.coefficients, self.dim)]
+        for pair in range(self.pairs):
+            yield self.spec(pair, 0, groups)
+        # reseeding one generator is much faster than making one per pair
+        random = np.random.RandomState()
+        for pair in self.pair_order.tolist():
+            group, process = divmod(pair, len(self.processes))
+            prefix = '{} {}.dat '.format(groups[group], self.processes[process])
+            starts = self.chunks(pair, random) * self.size
+            stops = np.minimum(starts + self.size, self.totalpoints)
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                yield '{}{}:{}'.format(prefix, start, stop)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('task index out of range')
+        if index < self.pairs:
+            return self.spec(index, 0)
+
+        slot, position = divmod(index - self.pairs, self.chunks_per_pair)
+        pair = int(self.pair_order[slot])
+        if self.other_chunks > self.permutation_limit:
+            return self.spec(pair, 1 + permute(position, self.other_chunks, self.seed, pair))
+        return self.spec(pair, int(self.chunks(pair)[position]))
+
+    def chunks(self, pair, random=None):
+        """Return the non-SM chunks of a pair, in the order in which they are calculated
+
+        Parameters
+        ----------
+            pair : int
+            random : np.random.RandomState
+                Generator to reseed for the pair, instead of making a new one.
+        """
+        if self.other_chunks > self.permutation_limit:
+            return 1 + np.array([permute(i, self.other_chunks, self.seed, pair) for i in range(self.chunks_per_pair)],
+                                dtype=np.int64)
+        if random is None:
+            random = np.random.RandomState()
+        random.seed([self.seed, pair])
+        order = random.permutation(self.other_chunks)
+        return 1 + order[:self.chunks_per_pair].astype(np.int64)
+
+    def spec(self, pair, chunk, groups=None):
+        group, process = divmod(pair, len(self.processes))
+        start = chunk * self.size
+        stop = min(start + self.size, self.totalpoints)
+        return '{} {}.dat {}:{}'.format(
+            groups[group] if groups is not None else ','.join(nth_combo(self.coefficients, self.dim, group)),
+            self.processes[process],
+            start,
+            stop
+        )
+
 def clone_cards(
         sm_gridpack,
         np_model,
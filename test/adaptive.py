@@ -0,0 +1,66 @@
+"""
+Calculate cross sections for several processes, choosing the points
+batch by batch where the fitted scaling is least certain, until the
+fit of every process has converged.
+
+"""
+import argparse
+
+from NPFitProduction.NPFitProduction.adaptive import AdaptiveScan
+from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, MadgraphRunner, get_bounds
+
+parser = argparse.ArgumentParser(description='calculate cross sections adaptively')
+parser.add_argument('cores', type=int, help='number of cores to use')
+parser.add_argument('events', type=int, help='number of events to use for cross section calculation')
+parser.add_argument('madgraph', type=str, help='tarball containing madgraph')
+parser.add_argument('np_model', type=str, help='tarball containing NP model')
+parser.add_argument('np_param_path', type=str,
+                    help='path (relative to the unpacked madgraph tarball) to the NP parameter card')
+parser.add_argument('cards', type=str,
+                    help='path to the cards directory (must contain run_card.dat, grid_card.dat, '
+                    'me5_configuration.txt and the parameter card pointed to by np_param_path)')
+parser.add_argument('scale', type=float, help='maximum scaling to constrain coefficient values')
+parser.add_argument('coefficients', type=str, help='comma-delimited list of wilson coefficients to scan')
+parser.add_argument('scan', type=str, help='coarse-grained scan points to constrain coefficient values')
+parser.add_argument('process_cards', type=str, nargs='+', help='which process cards to run')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of points to calculate concurrently, sharing the cores')
+parser.add_argument('--batch-size', type=int, default=10, help='number of points to add per process and iteration')
+parser.add_argument('--iterations', type=int, default=20, help='maximum number of iterations')
+parser.add_argument('--tolerance', type=float, default=0.01,
+                    help='relative change in the predicted scaling below which a process is done')
+parser.add_argument('--seed', type=int, default=None, help='seed for choosing points')
+args = parser.parse_args()
+
+args.coefficients = tuple(args.coefficients.split(','))
+cards = dict((card.split('/')[-1].replace('.dat', ''), card) for card in args.process_cards)
+coarse_scan = CrossSectionScan(args.scan.replace('file:', ''), mmap_mode='c')
+mins, maxes = get_bounds(args.coefficients, coarse_scan, args.scale)
+runner = MadgraphRunner(args.cores, args.jobs)
+
+adaptive = AdaptiveScan(
+    args.coefficients,
+    sorted(cards),
+    mins,
+    maxes,
+    batch_size=args.batch_size,
+    tolerance=args.tolerance,
+    seed=args.seed
+)
+
+
+def calculate(process, points):
+    return runner.run(
+        args.madgraph,
+        args.np_model,
+        args.np_param_path,
+        adaptive.coefficients,
+        cards[process],
+        args.events,
+        args.cards,
+        points
+    )
+
+
+result = adaptive.run(calculate, args.iterations, callback=lambda scan: scan.dump('cross_sections.npz'))
+result.dump('cross_sections.npz')
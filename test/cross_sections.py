@@ -30,6 +30,8 @@ low = -1. * cutoff
 high = 1. * cutoff
 scale_numvalues = 25  # number of values to use for scale scan
 interval_numvalues = 10  # number of values to use for interval scan
+design = None  # set to 'lhs' or 'd-optimal' to calculate design_size points per scale scan instead of a grid
+design_size = 100  # number of design points per coefficient group and process, including the SM point
 chunksize = 5
 maxchunks = 1000
 
@@ -84,29 +86,15 @@ scale_resources = Category(
 )
 
 
-def chunk(size, numvalues, processes, coefficients, dim=1):
+def chunk(size, numvalues, processes, coefficients, dim=1, totalpoints=None, seed=0):
     requiredpoints = 1. + 2. * dim + (dim - 1.) * dim / 2.
-    totalpoints = numvalues ** dim + 1
+    if totalpoints is None:
+        totalpoints = numvalues ** dim + 1
     if totalpoints < requiredpoints:
         raise ValueError('need more than {} points; {}d fit requires at least {}'.format(totalpoints, dim, requiredpoints))
-    if size > totalpoints:
-        size = totalpoints
-    res = []
-    sm = []
-    for coefficient_group in utils.sorted_combos(coefficients, dim):
-        for p in processes:
-            unique_args = []
-            for lower, higher in zip(np.arange(0, totalpoints, size), np.arange(size, totalpoints + 1, size)):
-                unique_args += ['{} {}.dat {}'.format(','.join(coefficient_group), p, ' '.join([str(x) for x in np.arange(lower, higher)]))]
-            sm += [unique_args.pop(0)]  # the first entry contains the SM point-- make sure we do not truncate it
-            if higher < totalpoints:
-                unique_args += ['{} {}.dat {}'.format(','.join(coefficient_group), p, ' '.join([str(x) for x in np.arange(higher, totalpoints)]))]
-            np.random.shuffle(unique_args)
-            unique_args = unique_args[:maxchunks]
-            res += unique_args
-    np.random.shuffle(res)
-
-    return sm + res
+
+    # tasks are 'group process.dat start:stop', generated when lobster reads them
+    return utils.TaskSpecs(size, totalpoints, processes, coefficients, dim, maxchunks, seed)
 
 
 interval = Workflow(
@@ -154,8 +142,9 @@ scale = Workflow(
             model=np_model,
             pp=np_param_path,
             cards=os.path.split(cards)[-1],
-            scale=scale),
-        unique_arguments=chunk(chunksize, scale_numvalues, processes, coefficients, dimension),
+            scale=scale) + (' --design {} --design-size {}'.format(design, design_size) if design else ''),
+        unique_arguments=chunk(chunksize, scale_numvalues, processes, coefficients, dimension,
+                               design_size if design else None),
         merge_command='merge_scans',
         merge_size='2G',
         # merge_maxinputs=50,
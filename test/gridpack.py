@@ -10,11 +10,12 @@ import os
 import re
 import shutil
 import subprocess
+import sys
 
 import numpy as np
 
-from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, get_points, setup_model
-from NPFitProduction.NPFitProduction.utils import cartesian_product, TempDir
+from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, get_bounds, setup_model
+from NPFitProduction.NPFitProduction.utils import Grid, TempDir
 
 parser = argparse.ArgumentParser(description='produce gridpacks')
 
@@ -43,36 +44,25 @@ args = parser.parse_args()
 
 args.coefficients = args.coefficients.split(',')
 process = args.process_card.split('/')[-1].replace('.dat', '')
-totalpoints = args.numvalues ** len(args.coefficients) + 1
 
 if args.scan and args.scale and args.constraints:
-    coarse_scan = CrossSectionScan([args.scan.replace('file:', '')])
-    coarse_scan.prune(args.constraints)
-    points = get_points(args.coefficients, coarse_scan, args.scale, args.numvalues)
+    coarse_scan = CrossSectionScan(args.scan.replace('file:', ''), mmap_mode='c')
     try:
-        mins, maxes = get_bounds(args.coefficients, coarse_scan, args.scale, args.interpolate_numvalues)
-    except RuntimeError:
-        raise
-
-    try:
-        points = None
-        for column, coefficient in enumerate(args.coefficients):
-            column = np.vstack([np.zeros(1), np.random.uniform(mins[column], maxes[column], (totalpoints, 1))])
-            if points is None:
-                points = column
-            else:
-                points = np.hstack([points, column])
+        mins, maxes = get_bounds(args.coefficients, coarse_scan, args.scale, processes=args.constraints.split(','))
     except RuntimeError as e:
-        print e
+        print(e)
         sys.exit(42)
+
+    if args.index == 0:
+        point = np.zeros(len(args.coefficients))
+    else:
+        point = np.array([np.random.uniform(mins[column], maxes[column]) for column in range(len(args.coefficients))])
 elif args.low and args.high:
     values = [np.hstack([np.zeros(1), np.linspace(args.low, args.high, args.numvalues)]) for c in args.coefficients]
-    points = cartesian_product(*values)
+    point = Grid(values)[args.index]
 else:
     raise NotImplementedError('either scale and scan or interval are required')
 
-point = points[args.index]
-
 start = os.getcwd()
 with TempDir() as sandbox:
     os.chdir(sandbox)
@@ -9,8 +9,10 @@ import sys
 
 import numpy as np
 
-from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, get_cross_section
-from NPFitProduction.NPFitProduction.utils import cartesian_product
+from NPFitProduction.NPFitProduction.cross_sections import ProcessCache, get_cross_section, \
+    get_cross_sections_reweighted, MadgraphRunner, ScanCheckpoint
+from NPFitProduction.NPFitProduction.design import DESIGNS
+from NPFitProduction.NPFitProduction.utils import Grid, parse_indices
 
 
 parser = argparse.ArgumentParser(description='calculate cross sections')
@@ -28,23 +30,58 @@ parser.add_argument('low', type=float, help='lowest coefficient value to conside
 parser.add_argument('high', type=float, help='highest coefficient value to consider')
 parser.add_argument('coefficients', type=str, help='comma-delimited list of wilson coefficients to scan')
 parser.add_argument('process_card', type=str, help='which process card to run')
-parser.add_argument('indices', type=int, nargs='+', help='the indices of points to calculate')
+parser.add_argument('indices', type=str, nargs='+',
+                    help='the indices of points to calculate, or ranges of them as start:stop')
+parser.add_argument('--reweight', action='store_true',
+                    help='generate one sample and calculate all points by reweighting it')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of points to calculate concurrently, sharing the cores')
+parser.add_argument('--design', choices=sorted(DESIGNS), default=None,
+                    help='calculate the points of a design of --design-size points instead of a grid')
+parser.add_argument('--design-size', type=int, default=None,
+                    help='number of design points, including the SM point (default: twice the number of fit constants)')
+parser.add_argument('--seed', type=int, default=0, help='seed for the design')
+parser.add_argument('--checkpoint', type=str, default='checkpoint.txt',
+                    help='file to record finished points in, which are skipped when restarting')
 
 args = parser.parse_args()
+args.indices = parse_indices(args.indices)
 args.coefficients = args.coefficients.split(',')
 process = args.process_card.split('/')[-1].replace('.dat', '')
 
-values = [np.linspace(args.low, args.high, args.numvalues, endpoint=True) for c in args.coefficients]
-points = np.vstack([np.zeros(len(args.coefficients)), cartesian_product(*values)])
-result = CrossSectionScan()
+if args.design:
+    dim = len(args.coefficients)
+    grid = DESIGNS[args.design]([args.low] * dim, [args.high] * dim, args.design_size, args.seed)
+    args.design_size = len(grid)
+else:
+    values = [np.linspace(args.low, args.high, args.numvalues, endpoint=True) for c in args.coefficients]
+    grid = Grid(values, sm=True)
+runner = MadgraphRunner(args.cores, args.jobs) if args.jobs > 1 else None
+# the runner sets up its own processes; only the other paths read the cache
+cache = ProcessCache() if args.reweight or runner is None else None
+checkpoint = ScanCheckpoint(args.checkpoint, dict(
+    process=process,
+    coefficients=','.join(args.coefficients),
+    numvalues=args.numvalues,
+    low=args.low,
+    high=args.high,
+    design=args.design,
+    design_size=args.design_size,
+    seed=args.seed
+))
+todo = checkpoint.missing(args.indices)
+# only the points of this job are calculated from the grid
+points = dict(zip(todo, grid[todo]))
 
 for attempt in range(5):
     # Sometimes MG can fail if the Wilson coefficient values are too large.
-    # If this happens, try again a few times with smaller values.
-    try:
-        for i in args.indices:
-            point = points[i]
-            cross_section, err = get_cross_section(
+    # If this happens, try again a few times with smaller values for the
+    # points which failed.
+    if len(todo) == 0:
+        break
+    if args.reweight:
+        try:
+            scan = get_cross_sections_reweighted(
                 args.madgraph,
                 args.np_model,
                 args.np_param_path,
@@ -53,16 +90,58 @@ for attempt in range(5):
                 args.cores,
                 args.events,
                 args.cards,
-                point
+                np.array([points[i] for i in todo]),
+                cache=cache
             )
-            result.add(point, cross_section, err, process, args.coefficients)
-        break
-    except RuntimeError as e:
-        print '{}: halving coefficient values and trying again'.format(e)
-        points = points / 2.
+            # scans are stored with the coefficients sorted, in the order of the points
+            coefficients = tuple(sorted(args.coefficients))
+            cross_sections = scan.cross_sections[coefficients].get(process, [])
+            errs = scan.errs[coefficients].get(process, [])
+            if len(cross_sections) != len(todo):
+                raise RuntimeError('expected {} reweighted points but got {}'.format(len(todo), len(cross_sections)))
+            for i, cross_section, err in zip(todo, cross_sections, errs):
+                checkpoint.record(i, points[i], cross_section, err)
+        except RuntimeError as e:
+            print '{}: halving coefficient values and trying again'.format(e)
+    elif runner is not None:
+        runner.run(
+            args.madgraph,
+            args.np_model,
+            args.np_param_path,
+            args.coefficients,
+            args.process_card,
+            args.events,
+            args.cards,
+            np.array([points[i] for i in todo]),
+            callback=lambda row, point, cross_section, err: checkpoint.record(todo[row], point, cross_section, err)
+        )
+    else:
+        for i in todo:
+            try:
+                cross_section, err = get_cross_section(
+                    args.madgraph,
+                    args.np_model,
+                    args.np_param_path,
+                    args.coefficients,
+                    args.process_card,
+                    args.cores,
+                    args.events,
+                    args.cards,
+                    points[i],
+                    cache=cache
+                )
+                checkpoint.record(i, points[i], cross_section, err)
+            except RuntimeError as e:
+                print '{}: halving coefficient values of point {} and trying again'.format(e, i)
+    todo = [i for i in todo if i not in checkpoint]
+    for i in todo:
+        points[i] = points[i] / 2.
 
-if len(result.points) is 0:
-    print 'failed to calculate any points'
+missing = checkpoint.missing(args.indices)
+if len(missing) > 0:
+    # a partial job would never be retried, and the scaling cannot be calculated without the SM point
+    print 'failed to calculate points {}'.format(', '.join(str(i) for i in missing))
     sys.exit(42)
-else:
-    result.dump('cross_sections.npz')
+
+result = checkpoint.scan(process, args.coefficients, args.indices)
+result.dump('cross_sections.npz')
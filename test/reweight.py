@@ -23,12 +23,7 @@ points = 600
 
 num_sampled_points = 1000000
 mins, maxes = cross_sections.get_bounds(coefficients, scan, scale)
-sampled_points = np.zeros((num_sampled_points, len(coefficients)))
-for i in range(num_sampled_points):
-    point = []
-    for column, coefficient in enumerate(coefficients):
-        point += [np.random.uniform(mins[column], maxes[column])]
-    sampled_points[i] = np.array([point])
+sampled_points, _ = cross_sections.sample_points(coefficients, scan, scale, num_sampled_points, processes=['ttZ'])
 
 scales = scan.evaluate(coefficients, sampled_points, 'ttZ').ravel()
 window = (scales > 2) & (scales < 5)
@@ -3,8 +3,10 @@ import sys
 
 import numpy as np
 
-from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, get_cross_section, get_bounds
-from NPFitProduction.NPFitProduction.utils import cartesian_product
+from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan, ProcessCache, get_cross_section, get_bounds, sample_points, \
+    get_cross_sections_reweighted, MadgraphRunner, ScanCheckpoint
+from NPFitProduction.NPFitProduction.design import DESIGNS
+from NPFitProduction.NPFitProduction.utils import parse_indices
 
 parser = argparse.ArgumentParser(description='calculate cross sections')
 
@@ -22,44 +24,76 @@ parser.add_argument('cards', type=str,
 parser.add_argument('scale', type=float, help='maximum scaling to constrain coefficient values')
 parser.add_argument('coefficients', type=str, help='comma-delimited list of wilson coefficients to scan')
 parser.add_argument('process_card', type=str, help='which process card to run')
-parser.add_argument('indices', type=int, nargs='+', help='the indices of points to calculate')
+parser.add_argument('indices', type=str, nargs='+',
+                    help='the indices of points to calculate, or ranges of them as start:stop')
 parser.add_argument('scan', type=str, help='coarse-grained scan points to constrain coefficient values')
+parser.add_argument('--region', action='store_true',
+                    help='sample points inside the region where NP / SM < scale instead of its bounding box')
+parser.add_argument('--design', choices=sorted(DESIGNS), default=None,
+                    help='calculate the points of a design of --design-size points inside the bounding box '
+                    'instead of random points')
+parser.add_argument('--design-size', type=int, default=None,
+                    help='number of design points, including the SM point (default: twice the number of fit constants)')
+parser.add_argument('--seed', type=int, default=0, help='seed for the design')
+parser.add_argument('--reweight', action='store_true',
+                    help='generate one sample and calculate all points by reweighting it')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of points to calculate concurrently, sharing the cores')
+parser.add_argument('--checkpoint', type=str, default='checkpoint.txt',
+                    help='file to record finished points in, which are skipped when restarting')
 args = parser.parse_args()
+args.indices = parse_indices(args.indices)
 
 args.coefficients = tuple(args.coefficients.split(','))
 process = args.process_card.split('/')[-1].replace('.dat', '')
-coarse_scan = CrossSectionScan([args.scan.replace('file:', '')])
-result = CrossSectionScan()
+coarse_scan = CrossSectionScan(args.scan.replace('file:', ''), mmap_mode='c')
+runner = MadgraphRunner(args.cores, args.jobs) if args.jobs > 1 else None
+# the runner sets up its own processes; only the other paths read the cache
+cache = ProcessCache() if args.reweight or runner is None else None
 
 try:
     mins, maxes = get_bounds(args.coefficients, coarse_scan, args.scale)
 except RuntimeError:
     raise
 
-# num_sampled_points = 10000
-# sampled_points = np.zeros((num_sampled_points, len(args.coefficients)))
-# for i in range(num_sampled_points):
-#     point = []
-#     for column, coefficient in enumerate(args.coefficients):
-#         point += [np.random.uniform(mins[column] * 2., maxes[column] * 2.)]
-#     sampled_points[i] = np.array([point])
-# for p in coarse_scan.points[args.coefficients]:
-#     scales = coarse_scan.evaluate(args.coefficients, sampled_points, p).ravel()
-#     sampled_points = sampled_points[scales < (args.scale)]
-# print 'sampled points are ', sampled_points[:10]
-# print 'sampled scales are ', scales[scales < args.scale][:10]
+if args.region:
+    sampled_points, _ = sample_points(args.coefficients, coarse_scan, args.scale, len(args.indices))
+elif args.design:
+    design = DESIGNS[args.design](mins, maxes, args.design_size, args.seed)
+    args.design_size = len(design)
 
+checkpoint = ScanCheckpoint(args.checkpoint, dict(
+    process=process,
+    coefficients=','.join(args.coefficients),
+    scale=args.scale,
+    scan=args.scan,
+    region=args.region,
+    design=args.design,
+    design_size=args.design_size,
+    seed=args.seed
+))
+todo = checkpoint.missing(args.indices)
+points = []
 for i, value in enumerate(args.indices):
-    try:
-        if value == 0:
-            # we must always include the SM point in order to calculate the scaling
-            point = [0.0] * len(args.coefficients)
-        else:
-            # point = sampled_points[i]
-            point = []
-            for column, coefficient in enumerate(args.coefficients):
-                point += [np.random.uniform(mins[column], maxes[column])]
-        cross_section, err = get_cross_section(
+    if value == 0:
+        # we must always include the SM point in order to calculate the scaling
+        point = [0.0] * len(args.coefficients)
+    elif args.region:
+        point = sampled_points[i]
+    elif args.design:
+        point = design[value]
+    else:
+        point = []
+        for column, coefficient in enumerate(args.coefficients):
+            point += [np.random.uniform(mins[column], maxes[column])]
+    if value in todo:
+        points.append(point)
+
+try:
+    if len(todo) == 0:
+        pass
+    elif args.reweight:
+        scan = get_cross_sections_reweighted(
             args.madgraph,
             args.np_model,
             args.np_param_path,
@@ -68,12 +102,56 @@ for i, value in enumerate(args.indices):
             args.cores,
             args.events,
             args.cards,
-            point
+            np.array(points),
+            cache=cache
         )
-        result.add(point, cross_section, err, process, args.coefficients)
-    except RuntimeError as e:
-        print e
-        sys.exit(42)
+        # scans are stored with the coefficients sorted, in the order of the points
+        coefficients = tuple(sorted(args.coefficients))
+        cross_sections = scan.cross_sections[coefficients].get(process, [])
+        errs = scan.errs[coefficients].get(process, [])
+        if len(cross_sections) != len(todo):
+            raise RuntimeError('expected {} reweighted points but got {}'.format(len(todo), len(cross_sections)))
+        for value, point, cross_section, err in zip(todo, points, cross_sections, errs):
+            checkpoint.record(value, point, cross_section, err)
+    elif runner is not None:
+        runner.run(
+            args.madgraph,
+            args.np_model,
+            args.np_param_path,
+            args.coefficients,
+            args.process_card,
+            args.events,
+            args.cards,
+            np.array(points),
+            callback=lambda row, point, cross_section, err: checkpoint.record(todo[row], point, cross_section, err)
+        )
+        if len(runner.failures) > 0:
+            raise RuntimeError('{} points failed'.format(len(runner.failures)))
+    else:
+        for value, point in zip(todo, points):
+            cross_section, err = get_cross_section(
+                args.madgraph,
+                args.np_model,
+                args.np_param_path,
+                args.coefficients,
+                args.process_card,
+                args.cores,
+                args.events,
+                args.cards,
+                point,
+                cache=cache
+            )
+            checkpoint.record(value, point, cross_section, err)
+except RuntimeError as e:
+    # the points which are done are kept in the checkpoint, so a retry only calculates the rest
+    print e
+    sys.exit(42)
+
+missing = checkpoint.missing(args.indices)
+if len(missing) > 0:
+    print 'failed to calculate points {}'.format(', '.join(str(i) for i in missing))
+    sys.exit(42)
 
+result = checkpoint.scan(process, args.coefficients, args.indices)
 print result
 result.dump('cross_sections.npz')
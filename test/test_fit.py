@@ -0,0 +1,59 @@
+"""
+Check that fits of a cross section scan do not depend on the interpreter's
+hash seed or on the number of workers.
+
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import unittest
+
+FIT = """
+from __future__ import print_function
+import itertools
+import os
+import sys
+
+import numpy as np
+
+from NPFitProduction.NPFitProduction.cross_sections import CrossSectionScan
+
+random = np.random.RandomState(0)
+scan = CrossSectionScan()
+coefficients = ['c{}'.format(i) for i in range(4)]
+for process in ['ttZ', 'ttW', 'ttH']:
+    for group in list(itertools.combinations(coefficients, 1)) + list(itertools.combinations(coefficients, 2)):
+        points = random.uniform(-1, 1, (30, len(group)))
+        points[0] = 0
+        cross_sections = 1 + 0.3 * points.sum(axis=1) + (points ** 2).sum(axis=1) + random.normal(0, 0.05, 30)
+        scan.add(points, cross_sections, np.full(30, 0.01), process, group)
+
+stdout = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+scan.fit(workers=int(sys.argv[1]))
+sys.stdout = stdout
+
+for constants in (scan.fit_constants, scan.fit_constants_errs):
+    for coefficients in sorted(constants):
+        for process in sorted(constants[coefficients]):
+            print(coefficients, process, constants[coefficients][process].tolist())
+"""
+
+
+def fit(hashseed, workers):
+    env = dict(os.environ, PYTHONHASHSEED=str(hashseed))
+    return subprocess.check_output([sys.executable, '-c', FIT, str(workers)], env=env)
+
+
+class TestFitDeterminism(unittest.TestCase):
+
+    def test_hash_seed(self):
+        self.assertEqual(fit(1, 1), fit(2, 1))
+
+    def test_workers(self):
+        self.assertEqual(fit(1, 1), fit(3, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
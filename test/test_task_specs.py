@@ -0,0 +1,95 @@
+"""
+Check that the lazily generated task arguments of `cross_sections.py` cover the
+same points as the list which `chunk` used to build, and are not slower to build.
+
+"""
+from __future__ import print_function
+import collections
+import pickle
+import time
+import unittest
+
+import numpy as np
+
+from NPFitProduction.NPFitProduction.utils import TaskSpecs, parse_indices, sorted_combos
+
+
+def baseline_chunk(size, totalpoints, processes, coefficients, dim, maxchunks):
+    """The original `chunk` of cross_sections.py, which builds and shuffles every task in memory
+    """
+    if size > totalpoints:
+        size = totalpoints
+    res = []
+    sm = []
+    for coefficient_group in sorted_combos(coefficients, dim):
+        for p in processes:
+            unique_args = []
+            for lower, higher in zip(np.arange(0, totalpoints, size), np.arange(size, totalpoints + 1, size)):
+                unique_args += ['{} {}.dat {}'.format(','.join(coefficient_group), p, ' '.join([str(x) for x in np.arange(lower, higher)]))]
+            sm += [unique_args.pop(0)]
+            if higher < totalpoints:
+                unique_args += ['{} {}.dat {}'.format(','.join(coefficient_group), p, ' '.join([str(x) for x in np.arange(higher, totalpoints)]))]
+            np.random.shuffle(unique_args)
+            unique_args = unique_args[:maxchunks]
+            res += unique_args
+    np.random.shuffle(res)
+
+    return sm + res
+
+
+def points(tasks):
+    """Return the point indices of each (group, process), and the number of tasks for it
+    """
+    indices = collections.defaultdict(list)
+    counts = collections.Counter()
+    for task in tasks:
+        fields = task.split()
+        indices[tuple(fields[:2])] += parse_indices(fields[2:])
+        counts[tuple(fields[:2])] += 1
+    return dict((key, sorted(value)) for key, value in indices.items()), counts
+
+
+class TestTaskSpecs(unittest.TestCase):
+
+    coefficients = ['c{}'.format(i) for i in range(12)]
+    processes = ['ttZ', 'ttW', 'ttH', 'tZq', 'tHq']
+
+    def test_same_points(self):
+        for dim, numvalues in [(1, 24), (2, 25), (3, 5)]:
+            totalpoints = numvalues ** dim + 1
+            tasks = TaskSpecs(5, totalpoints, self.processes, self.coefficients, dim, 1000)
+            baseline = baseline_chunk(5, totalpoints, self.processes, self.coefficients, dim, 1000)
+            self.assertEqual(len(tasks), len(baseline))
+            self.assertEqual(points(tasks), points(baseline))
+            self.assertTrue(all(task.endswith(' 0:5') for task in list(tasks)[:tasks.pairs]))
+
+    def test_maxchunks(self):
+        tasks = TaskSpecs(5, 25 ** 2 + 1, self.processes, self.coefficients, 2, 10)
+        indices, counts = points(tasks)
+        self.assertEqual(set(counts.values()), set([11]))
+        self.assertTrue(all(len(set(i)) == len(i) and i[:5] == [0, 1, 2, 3, 4] for i in indices.values()))
+
+    def test_random_access(self):
+        tasks = TaskSpecs(5, 25 ** 2 + 1, self.processes, self.coefficients, 2, 50, seed=3)
+        everything = list(tasks)
+        self.assertEqual([tasks[i] for i in range(0, len(tasks), 7)], everything[::7])
+        self.assertEqual(tasks[-1], everything[-1])
+        self.assertEqual(list(pickle.loads(pickle.dumps(tasks, 2))), everything)
+        self.assertNotEqual(list(TaskSpecs(5, 25 ** 2 + 1, self.processes, self.coefficients, 2, 50, seed=4)),
+                            everything)
+
+    def test_faster_than_baseline(self):
+        start = time.time()
+        baseline = baseline_chunk(5, 25 ** 2 + 1, self.processes, self.coefficients, 2, 1000)
+        baseline_time = time.time() - start
+
+        start = time.time()
+        tasks = list(TaskSpecs(5, 25 ** 2 + 1, self.processes, self.coefficients, 2, 1000))
+        tasks_time = time.time() - start
+
+        self.assertEqual(len(tasks), len(baseline))
+        self.assertLess(tasks_time, baseline_time)
+
+
+if __name__ == '__main__':
+    unittest.main()